@@ -14,7 +14,14 @@ import telegram.ext.filters as Filters
 from telegram.constants import SUPPORTED_WEBHOOK_PORTS
 
 from webshell import shell_process
+from worker import worker_process
 import handlers
+from modules.executor import search_pool, download_pool
+from modules.broker import WORKER_PROCESSES
+from modules.scheduler import scheduler
+from modules.metrics import registry, queue_depth
+from modules.eviction import get_eviction_engine
+from modules.manager import DOWNLOAD_PATH, resume_jobs, stop_resumed_jobs
 
 from constants import TEMP_DIR
 
@@ -29,13 +36,38 @@ def validate():
     ), f"Supported ports are f{SUPPORTED_WEBHOOK_PORTS}"
 
 
+def collect_queue_depth():
+    queue_depth.set(len(scheduler.queued_jobs()), queue="scheduler", state="queued")
+    queue_depth.set(len(scheduler.running), queue="scheduler", state="running")
+    for pool in (search_pool, download_pool):
+        queue_depth.set(pool.queued(), queue=pool.name, state="queued")
+        queue_depth.set(pool.running(), queue=pool.name, state="running")
+
+
 def bot_process():
     """Start the bot."""
 
     async def post_init(application: Application) -> None:
         await application.bot.set_my_commands(handlers.bot_commands)
-
-    application = Application.builder().token(TOKEN).post_init(post_init).build()
+        get_eviction_engine(DOWNLOAD_PATH).start()
+        await resume_jobs(application.bot)
+        registry.add_collector(collect_queue_depth)
+        registry.start("bot")
+
+    async def post_shutdown(application: Application) -> None:
+        await stop_resumed_jobs()
+        get_eviction_engine(DOWNLOAD_PATH).stop()
+        registry.stop()
+        search_pool.shutdown()
+        download_pool.shutdown()
+
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # # on different commands - answer in Telegram
     application.add_handler(CommandHandler("start", handlers.start, block=False))
@@ -109,6 +141,8 @@ if __name__ == "__main__":
             Process(target=bot_process),
             Process(target=shell_process),
         ]
+        # Searches and downloads run here instead of the bot process
+        processes += [Process(target=worker_process) for _ in range(WORKER_PROCESSES)]
         # Start all processes
         for proc in processes:
             proc.start()
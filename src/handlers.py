@@ -13,6 +13,12 @@ from telegram.constants import ChatAction
 from constants import RANDOM_RESPONSES, TEMP_DIR
 from modules.manager import Manager
 from modules.users import AuthManager
+from modules.executor import get_pool_stats
+from modules.scheduler import scheduler
+from modules.resolution_cache import resolution_cache
+from modules.downloader import get_download_stats
+from modules.status import status_updater
+from modules.tracing import format_slow_entry
 
 # import logging
 # Enable logging
@@ -80,7 +86,7 @@ async def cache_only(update: Update, context: CallbackContext):
         )
         return
     await m.process_songs(songs)
-    await msg.delete()
+    await status_updater.delete(msg)
 
 
 async def generate_response(update: Update, context: CallbackContext):
@@ -121,7 +127,7 @@ async def get_media(update: Update, context: CallbackContext):
     while len(retry_songs) > 0 and process_retry_count > 0:
         process_retry_count -= 1
         retry_songs = await m.process_songs(retry_songs)
-    await msg.delete()
+    await status_updater.delete(msg)
 
 
 async def search(update: Update, context: CallbackContext):
@@ -242,6 +248,9 @@ class DebugCommandHandler:
             "logs": self.list_logs,
             "reset": self.reset_files,
             "execute": self.execute,
+            "workers": self.list_workers,
+            "queue": self.list_queue,
+            "slow": self.list_slow,
         }
 
     def get_display_commands(self) -> List[str]:
@@ -259,6 +268,26 @@ class DebugCommandHandler:
     async def list_logs(self, add_args=None) -> str:
         return f"Logs:\n{await self.m.storage.get_logs()}"
 
+    def list_workers(self, add_args=None) -> str:
+        stats = {
+            **get_pool_stats(),
+            "resolution_cache": resolution_cache.stats(),
+            "downloads": get_download_stats(),
+            "eviction": self.m.eviction.stats(),
+        }
+        return f"Workers:\n{json.dumps(stats, indent=2)}"
+
+    def list_queue(self, add_args=None) -> str:
+        return f"Queue:\n{scheduler.describe()}"
+
+    async def list_slow(self, add_args=None) -> str:
+        entries = await self.m.storage.get_slowlog()
+        if add_args:
+            entries = entries[: int(add_args[0])]
+        if len(entries) == 0:
+            return "Slow requests:\nNone recorded"
+        return "Slow requests:\n" + "\n".join([format_slow_entry(entry) for entry in entries])
+
     def reset_files(self, add_args=None) -> str:
         self.m.storage.reset_directory()
         return self.list_files()
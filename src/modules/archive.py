@@ -0,0 +1,100 @@
+import os
+import uuid
+import asyncio
+import zipfile
+
+from constants import TEMP_DIR
+
+ARCHIVE_DIR = os.path.join(TEMP_DIR, "archives")
+# Bot API limits documents sent by bots to 50 MB, keep some headroom
+UPLOAD_LIMIT = int(os.environ.get("UPLOAD_LIMIT_MB", 49)) * 1024 * 1024
+# Local file header and central directory record per entry, without the filename
+ZIP_ENTRY_OVERHEAD = 30 + 46 + 64
+
+
+class EntryTooLarge(Exception):
+    """The file alone would make a part over the upload limit"""
+
+
+class ArchivePart:
+    def __init__(self, number: int) -> None:
+        self.number = number
+        self.path = os.path.join(ARCHIVE_DIR, uuid.uuid4().hex + ".zip")
+        self.zip_file = zipfile.ZipFile(self.path, "w")
+        self.size = 22  # End of central directory record
+        self.filenames = []
+
+    def write(self, filepath: str, filename: str, entry_size: int):
+        self.zip_file.write(filepath, filename)
+        self.size += entry_size
+        self.filenames.append(filename)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ZipArchive:
+    """
+    Zip file built incrementally off the event loop, one song at a time as downloads finish.
+    Parts are kept under max_bytes and handed to on_part(path, filename, entry_filenames) as soon as they fill,
+    the part file is removed once on_part returns.
+    Lives outside the download directory so storage cleanup never touches it.
+    """
+
+    def __init__(self, name: str = None, on_part=None, max_bytes: int = UPLOAD_LIMIT) -> None:
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        self.name = name if name is not None else "songs.zip"
+        self.on_part = on_part
+        self.max_bytes = max_bytes
+        self.lock = asyncio.Lock()
+        self.part: ArchivePart = None
+        self.part_number = 0
+        self.filenames = []
+
+    def get_part_name(self, part: ArchivePart, last_part: bool) -> str:
+        if last_part and part.number == 1:
+            return self.name
+        base_name = self.name[:-4] if self.name.endswith(".zip") else self.name
+        return f"{base_name}.part{part.number}.zip"
+
+    async def finish_part(self) -> ArchivePart:
+        part = self.part
+        self.part = None
+        if part is not None:
+            await asyncio.to_thread(part.zip_file.close)
+        return part
+
+    async def send_part(self, part: ArchivePart, last_part: bool):
+        if part is None:
+            return
+        try:
+            if self.on_part is not None:
+                await self.on_part(part.path, self.get_part_name(part, last_part), part.filenames)
+        finally:
+            part.remove()
+
+    async def add(self, filepath: str, filename: str):
+        entry_size = os.path.getsize(filepath) + ZIP_ENTRY_OVERHEAD + 2 * len(filename.encode())
+        if entry_size + 22 > self.max_bytes:
+            raise EntryTooLarge(f"{filename} is {entry_size} bytes, parts are limited to {self.max_bytes}")
+        full_part = None
+        async with self.lock:
+            if filename in self.filenames:
+                return
+            if self.part is not None and self.part.size + entry_size > self.max_bytes:
+                full_part = await self.finish_part()
+            if self.part is None:
+                self.part_number += 1
+                self.part = ArchivePart(self.part_number)
+            await asyncio.to_thread(self.part.write, filepath, filename, entry_size)
+            self.filenames.append(filename)
+        # Upload outside the lock so other songs keep filling the next part
+        await self.send_part(full_part, last_part=False)
+
+    async def close(self) -> int:
+        """Send the remaining part, returns the number of parts in the archive"""
+        async with self.lock:
+            last_part = await self.finish_part()
+        await self.send_part(last_part, last_part=True)
+        return self.part_number
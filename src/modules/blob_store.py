@@ -0,0 +1,106 @@
+import os
+import time
+import hashlib
+
+BLOB_DIR_NAME = "blobs"
+INCOMING_DIR_NAME = "incoming"
+HASH_CHUNK_SIZE = 1024 * 1024
+# Running downloads keep writing their incoming files, untouched ones were left by failed or killed downloads
+INCOMING_GRACE = 1800
+
+
+def hash_file(filepath: str) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BlobStore:
+    """
+    Content addressed audio files, named by the SHA-256 of their bytes.
+    Human friendly names in the storage location are hard links to the blobs
+    (symlinks where hard links are not supported), so identical audio is stored once.
+    Downloads land in the incoming directory first so titles never collide mid-download.
+    """
+
+    def __init__(self, storage_location: str) -> None:
+        self.blob_dir = os.path.join(storage_location, BLOB_DIR_NAME)
+        self.incoming_dir = os.path.join(self.blob_dir, INCOMING_DIR_NAME)
+        os.makedirs(self.incoming_dir, exist_ok=True)
+
+    def get_incoming_path(self, filename: str) -> str:
+        return os.path.join(self.incoming_dir, filename)
+
+    def get_blob_path(self, content_hash: str, extension: str) -> str:
+        return os.path.join(self.blob_dir, content_hash + extension)
+
+    def find(self, content_hash: str):
+        """Path of the blob with this hash, None if it is not stored"""
+        if content_hash is None:
+            return None
+        for filename in os.listdir(self.blob_dir):
+            if filename.startswith(content_hash):
+                return os.path.join(self.blob_dir, filename)
+        return None
+
+    def add(self, filepath: str, content_hash: str = None):
+        """Move a finished download into the store, returns its hash and blob path"""
+        if content_hash is None:
+            content_hash = hash_file(filepath)
+        blob_path = self.get_blob_path(content_hash, os.path.splitext(filepath)[1])
+        if os.path.exists(blob_path):
+            os.remove(filepath)
+        else:
+            os.replace(filepath, blob_path)
+        return content_hash, blob_path
+
+    def link(self, blob_path: str, link_path: str):
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        try:
+            os.link(blob_path, link_path)
+        except OSError:
+            os.symlink(os.path.relpath(blob_path, os.path.dirname(link_path)), link_path)
+
+    def is_linked(self, blob_path: str, link_path: str) -> bool:
+        return os.path.exists(link_path) and os.path.samefile(blob_path, link_path)
+
+    def collect_garbage(self, referenced_hashes: set, grace_seconds: float = 0) -> int:
+        """
+        Remove blobs no index entry refers to and no name links to, returns the count.
+        Blobs added less than grace_seconds ago may not be linked yet.
+        Abandoned partial downloads are removed from the incoming directory as well.
+        """
+        removed = self.collect_incoming(max(grace_seconds, INCOMING_GRACE))
+        for filename in os.listdir(self.blob_dir):
+            blob_path = os.path.join(self.blob_dir, filename)
+            if not os.path.isfile(blob_path):
+                continue
+            content_hash = os.path.splitext(filename)[0]
+            stat = os.stat(blob_path)
+            if time.time() - stat.st_ctime < grace_seconds:
+                continue
+            if content_hash not in referenced_hashes and stat.st_nlink == 1:
+                os.remove(blob_path)
+                removed += 1
+        return removed
+
+    def collect_incoming(self, grace_seconds: float) -> int:
+        removed = 0
+        for entry in os.scandir(self.incoming_dir):
+            try:
+                if entry.is_file() and time.time() - entry.stat().st_mtime >= grace_seconds:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+    def clear(self):
+        for directory in (self.blob_dir, self.incoming_dir):
+            for filename in os.listdir(directory):
+                filepath = os.path.join(directory, filename)
+                if os.path.isfile(filepath):
+                    os.remove(filepath)
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import sqlite3
+
+from constants import TEMP_DIR
+from modules.song import Song
+
+# Point every bot and worker at the same file. Same host only: the database runs in WAL mode,
+# which needs shared memory and doesn't work over a network filesystem. The same holds for
+# index.db and jobs.db in DOWNLOAD_PATH, a real message broker is needed to spread across hosts.
+BROKER_PATH = os.environ.get("BROKER_PATH", os.path.join(TEMP_DIR, "broker.db"))
+# Worker processes started by the Runner, 0 keeps searches and downloads in the bot process
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", 0))
+BROKER_POLL_INTERVAL = float(os.environ.get("BROKER_POLL_INTERVAL", 0.25))
+# A task claimed by a worker that died is handed out again after this
+BROKER_LEASE_SECONDS = int(os.environ.get("BROKER_LEASE_SECONDS", 1800))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def encode_value(value):
+    if isinstance(value, Song):
+        return {"__song__": value.to_dict()}
+    raise TypeError(f"Cannot send {type(value)} to a worker")
+
+
+def decode_value(value: dict):
+    if "__song__" in value:
+        return Song.from_dict(value["__song__"])
+    return value
+
+
+def encode(value) -> str:
+    return json.dumps(value, default=encode_value)
+
+
+def decode(text: str):
+    return json.loads(text, object_hook=decode_value)
+
+
+class Broker:
+    """
+    Local stand-in for a message broker: a SQLite task table shared by the bot and its workers on one host.
+    Workers claim tasks by queue name with a lease and write back the result or the error,
+    progress of running tasks is published through the same database.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.conn: sqlite3.Connection = None
+
+    def get_connection(self) -> sqlite3.Connection:
+        if self.conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # Transactions are explicit, see claim
+            self.conn = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            self.conn.row_factory = sqlite3.Row
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS tasks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    queue TEXT NOT NULL,
+                    fn TEXT NOT NULL,
+                    args TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    worker TEXT,
+                    created REAL NOT NULL,
+                    leased_until REAL
+                )"""
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS tasks_queue_state ON tasks (queue, state)")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS progress (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    updated REAL NOT NULL
+                )"""
+            )
+        return self.conn
+
+    def submit(self, queue: str, fn: str, args: tuple) -> int:
+        cursor = self.get_connection().execute(
+            "INSERT INTO tasks (queue, fn, args, state, created) VALUES (?, ?, ?, ?, ?)",
+            (queue, fn, encode(list(args)), QUEUED, time.time()),
+        )
+        return cursor.lastrowid
+
+    def claim(self, queue: str, worker: str):
+        """Oldest available task of the queue marked as running for the worker, None if there is none"""
+        conn = self.get_connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                """SELECT * FROM tasks WHERE queue = ?
+                AND (state = ? OR (state = ? AND leased_until < ?))
+                ORDER BY id LIMIT 1""",
+                (queue, QUEUED, RUNNING, now),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE tasks SET state = ?, worker = ?, leased_until = ? WHERE id = ?",
+                    (RUNNING, worker, now + BROKER_LEASE_SECONDS, row["id"]),
+                )
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return {"id": row["id"], "fn": row["fn"], "args": decode(row["args"])}
+
+    def complete(self, task_id: int, result):
+        self.get_connection().execute(
+            "UPDATE tasks SET state = ?, result = ? WHERE id = ?", (DONE, encode(result), task_id)
+        )
+
+    def fail(self, task_id: int, error: str):
+        self.get_connection().execute(
+            "UPDATE tasks SET state = ?, error = ? WHERE id = ?", (FAILED, error, task_id)
+        )
+
+    def get_task(self, task_id: int):
+        row = self.get_connection().execute(
+            "SELECT state, result, error FROM tasks WHERE id = ?", (task_id,)
+        ).fetchone()
+        return None if row is None else dict(row)
+
+    def get_result(self, task_id: int):
+        return decode(self.get_task(task_id)["result"])
+
+    def delete(self, task_id: int):
+        self.get_connection().execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+
+    def cancel(self, task_id: int) -> bool:
+        """Drop a task no worker has claimed yet"""
+        cursor = self.get_connection().execute(
+            "DELETE FROM tasks WHERE id = ? AND state = ?", (task_id, QUEUED)
+        )
+        return cursor.rowcount > 0
+
+    def count(self, queue: str, state: str) -> int:
+        return self.get_connection().execute(
+            "SELECT COUNT(*) FROM tasks WHERE queue = ? AND state = ?", (queue, state)
+        ).fetchone()[0]
+
+    def set_progress(self, key: str, values: dict):
+        conn = self.get_connection()
+        if values is None:
+            conn.execute("DELETE FROM progress WHERE key = ?", (key,))
+        else:
+            conn.execute(
+                "INSERT OR REPLACE INTO progress VALUES (?, ?, ?)",
+                (key, json.dumps(values), time.time()),
+            )
+
+    def get_progress(self, key: str):
+        row = self.get_connection().execute(
+            "SELECT value FROM progress WHERE key = ?", (key,)
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+
+broker = Broker(BROKER_PATH)
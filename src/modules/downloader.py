@@ -1,10 +1,244 @@
-# import asyncio
 # from youtube_dl import YoutubeDL
 import os
+import time
+import asyncio
+import threading
 from yt_dlp import YoutubeDL
 
 from constants import TEMP_DIR
 from modules.song import Song
+from modules.executor import search_pool, download_pool, report_progress
+from modules.resolution_cache import resolution_cache
+from modules.metrics import downloads, download_seconds, transcode_seconds, download_bytes
+from modules.matching import (
+    get_best_match,
+    get_fallback_query,
+    MATCH_CONFIDENT_SCORE,
+    QUICK_RESULT_COUNT,
+    FULL_RESULT_COUNT,
+)
+
+# mp3: always transcode, mp3 supports Embedding thumbnail
+# m4a: prefer AAC sources so most downloads are only remuxed
+# passthrough: keep the source codec, remuxed into its audio container
+OUTPUT_POLICIES = {
+    "mp3": {"format": "bestaudio/best", "codec": "mp3"},
+    "m4a": {"format": "bestaudio[ext=m4a]/bestaudio/best", "codec": "m4a"},
+    "passthrough": {"format": "bestaudio/best", "codec": "best"},
+}
+AUDIO_OUTPUT = os.environ.get("AUDIO_OUTPUT", "m4a")
+OUTPUT_POLICY = OUTPUT_POLICIES[AUDIO_OUTPUT]
+# Expected extension before the download, the actual one is known only afterwards
+CODEC = OUTPUT_POLICY["codec"] if OUTPUT_POLICY["codec"] != "best" else "m4a"
+
+MB = 1024 * 1024
+# Network tuning handed to yt-dlp, selected with DOWNLOAD_PROFILE
+DOWNLOAD_PROFILES = {
+    "balanced": {
+        "concurrent_fragment_downloads": 4,
+        "http_chunk_size": 10 * MB,
+        "retries": 10,
+        "fragment_retries": 10,
+        "socket_timeout": 20,
+    },
+    "fast": {
+        "concurrent_fragment_downloads": 8,
+        "http_chunk_size": 20 * MB,
+        "retries": 10,
+        "fragment_retries": 10,
+        "socket_timeout": 20,
+    },
+    "low-memory": {
+        "concurrent_fragment_downloads": 1,
+        "http_chunk_size": 1 * MB,
+        "buffersize": 16 * 1024,
+        "retries": 10,
+        "fragment_retries": 10,
+        "socket_timeout": 30,
+    },
+}
+DOWNLOAD_PROFILE = dict(DOWNLOAD_PROFILES[os.environ.get("DOWNLOAD_PROFILE", "balanced")])
+if os.environ.get("DOWNLOAD_CHUNK_SIZE_MB"):
+    DOWNLOAD_PROFILE["http_chunk_size"] = int(float(os.environ["DOWNLOAD_CHUNK_SIZE_MB"]) * MB)
+if os.environ.get("DOWNLOAD_CONCURRENT_FRAGMENTS"):
+    DOWNLOAD_PROFILE["concurrent_fragment_downloads"] = int(os.environ["DOWNLOAD_CONCURRENT_FRAGMENTS"])
+
+SEARCH_OPTS = {
+    "quiet": True,
+    "skip_download": True,
+    "extract_flat": True,
+    "format": "bestaudio/best",
+    "outtmpl": "%(title)s.%(ext)s",
+}
+
+# Totals of the downloads finished by this process
+download_stats = {"downloads": 0, "bytes": 0, "download_seconds": 0.0, "postprocess_seconds": 0.0}
+
+
+class DownloadLogger(object):
+    def debug(self, msg):
+        pass
+
+    def warning(self, msg):
+        pass
+
+    def error(self, msg):
+        print("Downloader Error - " + msg)
+
+
+def get_download_opts(outtmpl: str) -> dict:
+    return {
+        **DOWNLOAD_PROFILE,
+        # 'quiet': True,
+        # 'writethumbnail': True,
+        "age_limit": 30,
+        "nocheckcertificate": True,
+        "format": OUTPUT_POLICY["format"],
+        "outtmpl": outtmpl,
+        # Keep the download time as mtime, blob GC ages files in the incoming directory by it
+        "updatetime": False,
+        "postprocessors": [
+            {
+                # Copies the audio stream when it already matches the preferred codec
+                "key": "FFmpegExtractAudio",
+                "preferredcodec": OUTPUT_POLICY["codec"],
+                "preferredquality": "192",
+            },
+            # {'key': 'EmbedThumbnail'}
+        ],
+        "logger": DownloadLogger(),
+        "prefer_ffmpeg": True,
+        # 'ffmpeg_location': './'
+        "cookiefile": os.path.join(TEMP_DIR, "cookies.txt"),
+    }
+
+
+# One YoutubeDL per search thread, kept for the life of the thread
+search_local = threading.local()
+
+
+def get_search_ydl() -> YoutubeDL:
+    if getattr(search_local, "ydl", None) is None:
+        search_local.ydl = YoutubeDL(SEARCH_OPTS)
+    return search_local.ydl
+
+
+# Fields of search results used for matching and naming, see matching.py
+SEARCH_RESULT_FIELDS = [
+    "id",
+    "title",
+    "duration",
+    "channel",
+    "uploader",
+    "channel_is_verified",
+    "view_count",
+    "live_status",
+]
+
+
+def get_search_result(info: dict) -> dict:
+    """Full extractions carry formats and thumbnails, too large and not always JSON safe for the broker"""
+    return {field: info.get(field) for field in SEARCH_RESULT_FIELDS}
+
+
+def search_job(song: Song, result_count: int, query: str = None):
+    """Runs in the search thread pool"""
+    ydl = get_search_ydl()
+    if song.youtube_link is not None:
+        return get_search_result(ydl.extract_info(song.youtube_link, download=False))
+    if query is None:
+        query = song.get_search_query()
+    entries = ydl.extract_info(f"ytsearch{result_count}:{query}", download=False)["entries"]
+    return [get_search_result(entry) for entry in entries]
+
+
+# State of the download pool worker process, a worker runs one job at a time
+worker_ydl: YoutubeDL = None
+current_download = {}
+
+
+def progress_hook(d):
+    # Called for every downloaded chunk, only forward status changes and one update per second
+    if d["status"] == "finished":
+        current_download["bytes"] += d.get("total_bytes") or d.get("downloaded_bytes") or 0
+        current_download["download_seconds"] += d.get("elapsed") or 0
+    now = time.monotonic()
+    if d["status"] == current_download["status"] and now - current_download["reported"] < 1:
+        return
+    current_download["status"] = d["status"]
+    current_download["reported"] = now
+    report_progress(
+        current_download["youtube_id"],
+        {
+            "status": d["status"],
+            "downloaded": d.get("downloaded_bytes"),
+            "total": d.get("total_bytes") or d.get("total_bytes_estimate"),
+        },
+    )
+
+
+def get_worker_ydl() -> YoutubeDL:
+    """Long-lived instance so cookies, the HTTP connection pool and extractor state are reused"""
+    global worker_ydl
+    if worker_ydl is None:
+        ydl_opts = get_download_opts("%(title)s.%(ext)s")
+        ydl_opts["progress_hooks"] = [progress_hook]
+        worker_ydl = YoutubeDL(ydl_opts)
+    return worker_ydl
+
+
+def download_job(outtmpl: str, youtube_id: str) -> dict:
+    """
+    Runs in the download process pool, so it only receives picklable arguments.
+    Returns the path of the final audio file with the transfer stats of the download.
+    """
+    global worker_ydl
+    ydl = get_worker_ydl()
+    ydl.params["outtmpl"]["default"] = outtmpl
+    current_download.clear()
+    current_download.update(
+        youtube_id=youtube_id, status=None, reported=0, bytes=0, download_seconds=0.0
+    )
+    start = time.monotonic()
+    try:
+        info = ydl.extract_info(youtube_id, download=True)
+    except:
+        # Start over with a clean instance after a failure
+        worker_ydl = None
+        raise
+    finally:
+        report_progress(youtube_id, None)
+    total_seconds = time.monotonic() - start
+    return {
+        "filepath": info["requested_downloads"][0]["filepath"],
+        "bytes": current_download["bytes"],
+        "download_seconds": current_download["download_seconds"],
+        "postprocess_seconds": max(total_seconds - current_download["download_seconds"], 0),
+    }
+
+
+def record_download_stats(result: dict):
+    download_stats["downloads"] += 1
+    download_stats["bytes"] += result["bytes"]
+    download_stats["download_seconds"] += result["download_seconds"]
+    download_stats["postprocess_seconds"] += result["postprocess_seconds"]
+    downloads.inc(result="ok")
+    download_bytes.inc(result["bytes"])
+    download_seconds.observe(result["download_seconds"])
+    transcode_seconds.observe(result["postprocess_seconds"])
+
+
+def get_throughput(nbytes: int, seconds: float) -> float:
+    """MB/s"""
+    return round(nbytes / MB / seconds, 2) if seconds > 0 else 0
+
+
+def get_download_stats() -> dict:
+    return {
+        "profile": os.environ.get("DOWNLOAD_PROFILE", "balanced"),
+        **download_stats,
+        "throughput_mb_s": get_throughput(download_stats["bytes"], download_stats["download_seconds"]),
+    }
 
 
 class Downloader:
@@ -13,75 +247,41 @@ class Downloader:
         # self.lock = asyncio.Lock()
         self.max_retries = 3
         self.logging_func = logger
-        self.codec = "mp3"  # mp3 supports Embedding thumbnail
-
-        class MyLogger(object):
-            def debug(self, msg):
-                # logger('Downloader Debug - ' + msg)
-                pass
-
-            def warning(self, msg):
-                # logger('Downloader Warn - ' + msg)
-                pass
-
-            def error(self, msg):
-                logger("Downloader Error - " + msg)
-
-        self.ydl_opts_download = {
-            # 'quiet': True,
-            # 'writethumbnail': True,
-            "age_limit": 30,
-            "nocheckcertificate": True,
-            "format": "bestaudio/best",
-            "outtmpl": self.DOWNLOAD_PATH + "%(title)s.%(ext)s",
-            "postprocessors": [
-                {
-                    "key": "FFmpegExtractAudio",
-                    "preferredcodec": self.codec,
-                    "preferredquality": "192",
-                },
-                # {'key': 'EmbedThumbnail'}
-            ],
-            "logger": MyLogger(),
-            "prefer_ffmpeg": True,
-            # 'ffmpeg_location': './'
-            "cookiefile": os.path.join(TEMP_DIR, "cookies.txt"),
-        }
-        self.ydl_opts_search = {
-            "quiet": True,
-            "skip_download": True,
-            "extract_flat": True,
-            "format": "bestaudio/best",
-            "outtmpl": "%(title)s.%(ext)s",
-        }
-
-    async def retrieve_youtube_id(self, song: Song) -> bool:
+        self.codec = CODEC
+        self.ydl_opts_search = SEARCH_OPTS
 
-        def get_best_match(results, song: Song):
-            best_match = results[0]
-            if song.duration is not None:
-                d = song.duration
-                d_diff = 1000000
-                for v in results:
-                    if v["duration"] and (abs(v["duration"] - d) < d_diff):
-                        d_diff = abs(v["duration"] - d)
-                        best_match = v
-            return best_match
+    async def search_best_match(self, song: Song) -> dict:
+        results = await search_pool.run(search_job, song, QUICK_RESULT_COUNT)
+        video, score = get_best_match(song, results)
+        fallback_query = get_fallback_query(song)
+        if score < MATCH_CONFIDENT_SCORE and fallback_query is not None:
+            # YouTube returns one page per search either way, a different query finds other results
+            results = await search_pool.run(
+                search_job, song, FULL_RESULT_COUNT, fallback_query
+            )
+            fallback_video, fallback_score = get_best_match(song, results)
+            if fallback_score > score:
+                video, score = fallback_video, fallback_score
+        if video is None:
+            raise Exception("No search results")
+        self.logging_func(f"Best match: {video.get('title')} ({video['id']}), score {score:.2f}")
+        return video
 
+    async def retrieve_youtube_id(self, song: Song) -> bool:
+        """Search YouTube for the song, cached resolutions are looked up in bulk by BatchResolver"""
         try:
-            with YoutubeDL(self.ydl_opts_search) as ydl:
-                if song.youtube_link is not None:
-                    video = ydl.extract_info(song.youtube_link, download=False)
-                else:
-                    results = ydl.extract_info(
-                        f"ytsearch{10}:{song.get_search_query()}", download=False
-                    )["entries"]
-                    video = get_best_match(results, song)
-                video["ext"] = self.codec
+            if song.youtube_link is not None:
+                video = await search_pool.run(search_job, song, 1)
+            else:
+                video = await self.search_best_match(song)
+            video["ext"] = self.codec
+            song.filename = get_search_ydl().prepare_filename(video)
             song.youtube_id = video["id"]
-            song.filename = ydl.prepare_filename(video)
+            resolution_cache.store(song, duration=video.get("duration"))
             song.message = "Search successful"
             self.logging_func('Search for "' + song.get_display_name() + '" successful!')
+        except asyncio.CancelledError:
+            raise
         except:
             song.message = "Search failed"
             self.logging_func('Search for "' + song.get_display_name() + '" failed!')
@@ -91,15 +291,24 @@ class Downloader:
         file_downloaded = False
         # await self.lock.acquire()
         try:
-            outfilepath = outfilepath.replace(self.codec, "%(ext)s")
-            file_ydl_opts = {**self.ydl_opts_download}
-            file_ydl_opts["outtmpl"] = outfilepath
-            with YoutubeDL(file_ydl_opts) as ydl:
-                ydl.download([song.youtube_id])
+            outtmpl = os.path.splitext(outfilepath)[0] + ".%(ext)s"
+            result = await download_pool.run(download_job, outtmpl, song.youtube_id)
+            record_download_stats(result)
+            song.trace.add("transcode", result["postprocess_seconds"])
+            song.filename = os.path.basename(result["filepath"])
+            song.codec = os.path.splitext(result["filepath"])[1][1:]
             song.message = "Download started"
             file_downloaded = True
             self.logging_func('Download for "' + song.get_display_name() + '" Started!')
+            self.logging_func(
+                f"Transferred {result['bytes']} bytes in {result['download_seconds']:.1f}s"
+                f" ({get_throughput(result['bytes'], result['download_seconds'])} MB/s),"
+                f" post-processing {result['postprocess_seconds']:.1f}s"
+            )
+        except asyncio.CancelledError:
+            raise
         except:
+            downloads.inc(result="failed")
             song.message = "Download couldn't start"
             file_downloaded = False
             self.logging_func(
@@ -0,0 +1,197 @@
+import os
+import asyncio
+
+from modules.storage import Storage
+from modules.locking import get_lock
+from modules.index_store import (
+    FILENAME_FIELD,
+    FILE_ID_FIELD,
+    TIMESTAMP_FIELD,
+    ACCESS_COUNT_FIELD,
+    LAST_ACCESS_FIELD,
+)
+
+STORAGE_BUDGET = int(float(os.environ.get("STORAGE_BUDGET_MB", 2048)) * 1024 * 1024)
+EVICTION_POLICY = os.environ.get("EVICTION_POLICY", "lru")
+EVICTION_INTERVAL = int(os.environ.get("EVICTION_INTERVAL", 600))
+# Downloads are linked under their name shortly before they are indexed
+CLEAN_GRACE = 300
+
+
+def get_last_access(entry: dict):
+    # Entries from before access tracking only have their download time
+    return entry[LAST_ACCESS_FIELD] or entry[TIMESTAMP_FIELD]
+
+
+# Entries with the lowest key are evicted first
+EVICTION_POLICIES = {
+    "lru": get_last_access,
+    "lfu": lambda entry: (entry[ACCESS_COUNT_FIELD], get_last_access(entry)),
+}
+
+
+def scan_files(storage: Storage):
+    """
+    Sizes of the song files in the storage location and the names linking to each of them,
+    keyed by inode. Hard links and symlinks to a blob resolve to the blob's inode,
+    so shared audio is counted once. Blobs without names are left to garbage collection.
+    Downloads in the incoming directory count towards the usage without names, they can't be evicted.
+    Blocking, stats every file.
+    """
+    sizes = {}
+    names = {}
+    # The index database and logs are not evictable
+    reserved_filenames = storage.get_reserved_filenames()
+    for entry in os.scandir(storage.storage_location):
+        try:
+            if entry.name in reserved_filenames or not entry.is_file():
+                continue
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        inode = (stat.st_dev, stat.st_ino)
+        sizes[inode] = stat.st_size
+        names.setdefault(inode, set()).add(entry.name)
+    for entry in os.scandir(storage.blobs.incoming_dir):
+        try:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        inode = (stat.st_dev, stat.st_ino)
+        sizes[inode] = stat.st_size
+        names.setdefault(inode, set())
+    return sizes, names
+
+
+class EvictionEngine:
+    """
+    Keeps the download directory within a byte budget.
+    Index entries are ranked by the eviction policy using the access counts recorded in the index,
+    songs being processed are pinned and never evicted. Runs periodically in the background.
+    """
+
+    def __init__(self, storage: Storage, budget: int = STORAGE_BUDGET, policy: str = EVICTION_POLICY) -> None:
+        self.storage = storage
+        self.budget = budget
+        self.policy = policy
+        self.get_key = EVICTION_POLICIES[policy]
+        self.pinned = 0
+        self.task: asyncio.Task = None
+        self.usage = None
+        self.evicted = 0
+        self.freed = 0
+
+    # Pins are recorded in the job store, so processes sharing the storage location see each other's
+
+    def pin(self, youtube_id: str):
+        self.storage.jobs.pin(youtube_id)
+
+    def unpin(self, youtube_id: str):
+        self.storage.jobs.unpin(youtube_id)
+
+    def select_victims(self, sizes: dict, names: dict, pinned_ids: set) -> list:
+        """Entries to evict until the usage fits the budget, pinned entries are skipped"""
+        usage = sum(sizes.values())
+        inodes = {}
+        for inode, filenames in names.items():
+            for filename in filenames:
+                inodes[filename] = inode
+        victims = []
+        entries = sorted(self.storage.index.entries(), key=self.get_key)
+        for entry in entries:
+            if usage <= self.budget:
+                break
+            inode = inodes.get(entry[FILENAME_FIELD])
+            if inode is None or entry["youtube_id"] in pinned_ids:
+                continue
+            victims.append(entry)
+            names[inode].discard(entry[FILENAME_FIELD])
+            # The audio is freed once no name links to it
+            if len(names[inode]) == 0:
+                usage -= sizes[inode]
+        self.usage = usage
+        return victims
+
+    def remove_files(self, victims: list):
+        for entry in victims:
+            filepath = self.storage.get_filepath(entry[FILENAME_FIELD])
+            if os.path.lexists(filepath):
+                os.remove(filepath)
+
+    def evict(self, victims: list):
+        """Index part of the eviction, after remove_files"""
+        # Uploaded songs can still be sent by file_id, keep their entries without the audio
+        self.storage.index.delete([v["youtube_id"] for v in victims if v[FILE_ID_FIELD] is None])
+        self.storage.index.clear_content_hash(
+            [v["youtube_id"] for v in victims if v[FILE_ID_FIELD] is not None]
+        )
+        self.evicted += len(victims)
+
+    async def run(self):
+        # One process at a time evicts from a shared storage location
+        lock = get_lock(self.storage.storage_location, "eviction")
+        if not lock.acquire(blocking=False):
+            return
+        try:
+            await self.evict_over_budget()
+        finally:
+            lock.release()
+
+    async def evict_over_budget(self):
+        # Index rows are read and written here, the filesystem is swept in a thread.
+        # Entries without a file or file_id and unindexed files go first.
+        index = self.storage.index
+        missing = await asyncio.to_thread(self.storage.find_missing, index.entries())
+        index.delete(missing)
+        await asyncio.to_thread(
+            self.storage.sweep_files, index.filenames(), index.content_hashes(), CLEAN_GRACE
+        )
+        sizes, names = await asyncio.to_thread(scan_files, self.storage)
+        usage = sum(sizes.values())
+        pinned_ids = await asyncio.to_thread(self.storage.jobs.pinned_ids)
+        self.pinned = len(pinned_ids)
+        victims = self.select_victims(sizes, names, pinned_ids)
+        if len(victims) > 0:
+            await asyncio.to_thread(self.remove_files, victims)
+            self.evict(victims)
+            # Evicted blobs were just unlinked, they are collected by the next run
+            self.freed += usage - self.usage
+            print(f"Evicted {len(victims)} songs, storage usage {self.usage} of {self.budget} bytes")
+
+    async def run_forever(self, interval: int = EVICTION_INTERVAL):
+        while True:
+            try:
+                await self.run()
+            except Exception as e:
+                print("Eviction failed:", e)
+            await asyncio.sleep(interval)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run_forever())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def stats(self) -> dict:
+        return {
+            "policy": self.policy,
+            "budget": self.budget,
+            "usage": self.usage,
+            "pinned": self.pinned,
+            "evicted": self.evicted,
+            "freed": self.freed,
+        }
+
+
+eviction_engines = {}
+
+
+def get_eviction_engine(storage_location: str) -> EvictionEngine:
+    if storage_location not in eviction_engines:
+        eviction_engines[storage_location] = EvictionEngine(Storage(storage_location))
+    return eviction_engines[storage_location]
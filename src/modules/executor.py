@@ -0,0 +1,216 @@
+import os
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+
+from modules.broker import (
+    broker,
+    Broker,
+    WORKER_PROCESSES,
+    BROKER_POLL_INTERVAL,
+    QUEUED,
+    RUNNING,
+    DONE,
+    FAILED,
+)
+
+SEARCH_WORKERS = int(os.environ.get("SEARCH_WORKERS", 4))
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 2))
+# Downloads that can actually run at once, the scheduler admits no more than this
+DOWNLOAD_CONCURRENCY = WORKER_PROCESSES if WORKER_PROCESSES > 0 else DOWNLOAD_WORKERS
+
+# Progress reported by jobs running in worker processes, keyed by the job's own key
+progress_queue = multiprocessing.Queue()
+job_progress = {}
+worker_progress_queue = None
+# Set in worker processes of the broker, progress is published through it
+worker_broker: Broker = None
+progress_reader: threading.Thread = None
+
+
+def init_progress_reporting(queue):
+    """Pool worker initializer"""
+    global worker_progress_queue
+    worker_progress_queue = queue
+
+
+def init_broker_reporting(worker_broker_: Broker):
+    """Broker worker initializer"""
+    global worker_broker
+    worker_broker = worker_broker_
+
+
+def report_progress(key, values: dict):
+    """Called from inside a pool worker, values None clears the entry"""
+    if worker_progress_queue is not None:
+        worker_progress_queue.put((key, values))
+    elif worker_broker is not None:
+        worker_broker.set_progress(key, values)
+
+
+def read_progress():
+    while True:
+        key, values = progress_queue.get()
+        if values is None:
+            job_progress.pop(key, None)
+        else:
+            job_progress[key] = values
+
+
+def start_progress_reader():
+    global progress_reader
+    if progress_reader is None:
+        progress_reader = threading.Thread(target=read_progress, daemon=True)
+        progress_reader.start()
+
+
+def get_progress(key) -> dict:
+    if WORKER_PROCESSES > 0:
+        return broker.get_progress(key)
+    return job_progress.get(key)
+
+
+class WorkerPool:
+    """
+    Lazily created executor that runs blocking jobs off the event loop
+    and keeps track of the jobs it has accepted.
+    """
+
+    def __init__(self, name: str, executor_class, max_workers: int, report_progress=False) -> None:
+        self.name = name
+        self.executor_class = executor_class
+        self.max_workers = max_workers
+        self.report_progress = report_progress
+        self.executor: Executor = None
+        self.futures = set()
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def get_executor(self) -> Executor:
+        if self.executor is None:
+            if self.report_progress:
+                start_progress_reader()
+                self.executor = self.executor_class(
+                    max_workers=self.max_workers,
+                    initializer=init_progress_reporting,
+                    initargs=(progress_queue,),
+                )
+            else:
+                self.executor = self.executor_class(max_workers=self.max_workers)
+        return self.executor
+
+    def on_done(self, future):
+        self.futures.discard(future)
+        if future.cancelled():
+            self.cancelled += 1
+        elif future.exception() is not None:
+            self.failed += 1
+        else:
+            self.completed += 1
+
+    async def run(self, fn, *args):
+        """Run fn(*args) in the pool. Cancelling the awaiting task drops the job if it has not started yet."""
+        future = self.get_executor().submit(fn, *args)
+        self.futures.add(future)
+        future.add_done_callback(self.on_done)
+        return await asyncio.wrap_future(future)
+
+    def queued(self) -> int:
+        return sum([not f.running() and not f.done() for f in self.futures])
+
+    def running(self) -> int:
+        return sum([f.running() for f in self.futures])
+
+    def cancel_pending(self) -> int:
+        return sum([f.cancel() for f in list(self.futures)])
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.max_workers,
+            "queued": self.queued(),
+            "running": self.running(),
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+        }
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+class BrokerPool:
+    """
+    WorkerPool counterpart that hands jobs to separate worker processes through the broker.
+    Jobs are sent by function name, their arguments and results must be JSON serializable or Songs.
+    """
+
+    def __init__(self, name: str, broker: Broker) -> None:
+        self.name = name
+        self.broker = broker
+        self.task_ids = set()
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    async def run(self, fn, *args):
+        """Run fn(*args) on a worker. Cancelling the awaiting task drops the job if it has not started yet."""
+        task_id = self.broker.submit(self.name, fn.__name__, args)
+        self.task_ids.add(task_id)
+        try:
+            while True:
+                await asyncio.sleep(BROKER_POLL_INTERVAL)
+                task = self.broker.get_task(task_id)
+                if task["state"] == DONE:
+                    self.completed += 1
+                    return self.broker.get_result(task_id)
+                if task["state"] == FAILED:
+                    self.failed += 1
+                    raise Exception(f"{fn.__name__} failed on worker: {task['error']}")
+        except asyncio.CancelledError:
+            if self.broker.cancel(task_id):
+                self.cancelled += 1
+            raise
+        finally:
+            self.task_ids.discard(task_id)
+            self.broker.delete(task_id)
+
+    def queued(self) -> int:
+        return self.broker.count(self.name, QUEUED)
+
+    def running(self) -> int:
+        return self.broker.count(self.name, RUNNING)
+
+    def cancel_pending(self) -> int:
+        cancelled = sum([self.broker.cancel(task_id) for task_id in list(self.task_ids)])
+        self.cancelled += cancelled
+        return cancelled
+
+    def stats(self) -> dict:
+        return {
+            "workers": WORKER_PROCESSES,
+            "queued": self.queued(),
+            "running": self.running(),
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+        }
+
+    def shutdown(self):
+        self.cancel_pending()
+
+
+# Metadata extraction is mostly network bound, downloads include FFmpeg transcodes
+if WORKER_PROCESSES > 0:
+    search_pool = BrokerPool("search", broker)
+    download_pool = BrokerPool("download", broker)
+else:
+    search_pool = WorkerPool("search", ThreadPoolExecutor, SEARCH_WORKERS)
+    download_pool = WorkerPool("download", ProcessPoolExecutor, DOWNLOAD_WORKERS, report_progress=True)
+
+
+def get_pool_stats() -> dict:
+    return {pool.name: pool.stats() for pool in (search_pool, download_pool)}
@@ -0,0 +1,181 @@
+import os
+import json
+import sqlite3
+from datetime import datetime
+
+INDEX_DB_FILENAME = "index.db"
+LEGACY_INDEX_FILENAME = "index.json"
+FILENAME_FIELD = "filename"
+TIMESTAMP_FIELD = "timestamp"
+UPLOADED_FIELD = "uploaded"
+FILE_ID_FIELD = "file_id"
+SPOTIFY_ID_FIELD = "spotify_id"
+CODEC_FIELD = "codec"
+CONTENT_HASH_FIELD = "content_hash"
+ACCESS_COUNT_FIELD = "access_count"
+LAST_ACCESS_FIELD = "last_access"
+
+# Pseudo entries of the legacy JSON index
+LEGACY_RESERVED_KEYS = ["INDEX", "LOG"]
+
+
+class IndexStore:
+    """
+    SQLite (WAL) backed index of downloaded songs keyed on YouTube ID.
+    Every write is a row-level upsert committed immediately.
+    """
+
+    def __init__(self, storage_location: str) -> None:
+        self.storage_location = storage_location
+        self.db_path = os.path.join(storage_location, INDEX_DB_FILENAME)
+        # Writers in other processes are waited for instead of failing with "database is locked"
+        self.conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS songs (
+                youtube_id TEXT PRIMARY KEY,
+                spotify_id TEXT,
+                filename TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                uploaded INTEGER NOT NULL DEFAULT 0,
+                file_id TEXT,
+                codec TEXT,
+                content_hash TEXT,
+                access_count INTEGER NOT NULL DEFAULT 0,
+                last_access TEXT
+            )"""
+        )
+        self.add_missing_columns(
+            {
+                CODEC_FIELD: "TEXT",
+                CONTENT_HASH_FIELD: "TEXT",
+                ACCESS_COUNT_FIELD: "INTEGER NOT NULL DEFAULT 0",
+                LAST_ACCESS_FIELD: "TEXT",
+            }
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS songs_spotify_id ON songs (spotify_id)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS songs_timestamp ON songs (timestamp)")
+        self.conn.commit()
+        self.migrate_legacy_index(os.path.join(storage_location, LEGACY_INDEX_FILENAME))
+
+    def has_file(self, filename: str) -> bool:
+        """Checked on disk, other processes sharing the location add and evict files"""
+        if filename is None:
+            return False
+        return os.path.exists(os.path.join(self.storage_location, filename))
+
+    def add_missing_columns(self, columns: dict):
+        existing_columns = [row["name"] for row in self.conn.execute("PRAGMA table_info(songs)")]
+        for column, column_type in columns.items():
+            if column not in existing_columns:
+                self.conn.execute(f"ALTER TABLE songs ADD COLUMN {column} {column_type}")
+
+    def migrate_legacy_index(self, legacy_path: str):
+        if not os.path.exists(legacy_path):
+            return
+        try:
+            with open(legacy_path, "r") as f:
+                legacy_index = json.load(f)
+        except:
+            legacy_index = {}
+        rows = [
+            (
+                youtube_id,
+                v[FILENAME_FIELD],
+                v[TIMESTAMP_FIELD],
+                int(bool(v.get(UPLOADED_FIELD))),
+                v.get(FILE_ID_FIELD),
+            )
+            for youtube_id, v in legacy_index.items()
+            if youtube_id not in LEGACY_RESERVED_KEYS
+        ]
+        with self.conn:
+            self.conn.executemany(
+                """INSERT OR IGNORE INTO songs (youtube_id, filename, timestamp, uploaded, file_id)
+                VALUES (?, ?, ?, ?, ?)""",
+                rows,
+            )
+        os.remove(legacy_path)
+        print(f"Migrated {len(rows)} index entries from {legacy_path}")
+
+    def get(self, youtube_id: str):
+        row = self.conn.execute(
+            "SELECT * FROM songs WHERE youtube_id = ?", (youtube_id,)
+        ).fetchone()
+        return None if row is None else dict(row)
+
+    def upsert(self, youtube_id: str, spotify_id: str, filename: str, codec: str, content_hash: str = None):
+        """Insert or refresh an entry, keeping the Telegram file_id of a previous upload"""
+        with self.conn:
+            self.conn.execute(
+                """INSERT INTO songs (youtube_id, spotify_id, filename, timestamp, uploaded, codec, content_hash)
+                VALUES (?, ?, ?, ?, 0, ?, ?)
+                ON CONFLICT (youtube_id) DO UPDATE SET
+                    spotify_id = COALESCE(excluded.spotify_id, spotify_id),
+                    filename = excluded.filename,
+                    timestamp = excluded.timestamp,
+                    uploaded = file_id IS NOT NULL,
+                    codec = COALESCE(excluded.codec, codec),
+                    content_hash = COALESCE(excluded.content_hash, content_hash)""",
+                (youtube_id, spotify_id, filename, datetime.utcnow().isoformat(), codec, content_hash),
+            )
+
+    def set_uploaded(self, youtube_id: str, file_id=None):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE songs SET uploaded = 1, file_id = ? WHERE youtube_id = ?",
+                (file_id, youtube_id),
+            )
+
+    def record_access(self, youtube_id: str):
+        with self.conn:
+            self.conn.execute(
+                """UPDATE songs SET access_count = access_count + 1, last_access = ?
+                WHERE youtube_id = ?""",
+                (datetime.utcnow().isoformat(), youtube_id),
+            )
+
+    def clear_content_hash(self, youtube_ids):
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE songs SET content_hash = NULL WHERE youtube_id = ?", [(k,) for k in youtube_ids]
+            )
+
+    def entries(self):
+        return [dict(row) for row in self.conn.execute("SELECT * FROM songs")]
+
+    def filenames(self):
+        return set([row[0] for row in self.conn.execute("SELECT filename FROM songs")])
+
+    def content_hashes(self):
+        rows = self.conn.execute("SELECT content_hash FROM songs WHERE content_hash IS NOT NULL")
+        return set([row[0] for row in rows])
+
+    def delete(self, youtube_ids):
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM songs WHERE youtube_id = ?", [(k,) for k in youtube_ids]
+            )
+
+    def delete_uploaded(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM songs WHERE uploaded = 1")
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM songs")
+
+    def database_filenames(self):
+        return [INDEX_DB_FILENAME, INDEX_DB_FILENAME + "-wal", INDEX_DB_FILENAME + "-shm"]
+
+
+# One store per storage location for the whole process
+index_stores = {}
+
+
+def get_index_store(storage_location: str) -> IndexStore:
+    if storage_location not in index_stores:
+        index_stores[storage_location] = IndexStore(storage_location)
+    return index_stores[storage_location]
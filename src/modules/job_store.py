@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+
+from modules.song import Song
+from modules.locking import get_lock, LOCK_DIR_NAME
+
+JOBS_DB_FILENAME = "jobs.db"
+
+# States of a job's songs, a job is finished once the batch was processed
+PENDING = "pending"
+RESOLVED = "resolved"
+DOWNLOADED = "downloaded"
+SENT = "sent"
+FAILED = "failed"
+
+# Each process holds the lock named after it while it runs, jobs of owners whose lock is free are orphaned
+OWNER_LOCK_PREFIX = "owner-"
+
+
+class JobStore:
+    """
+    SQLite (WAL) record of the batches being processed, one row per requested song
+    with its resolution and download state, so batches interrupted by a restart can be resumed.
+    Jobs record the process that owns them, other processes sharing the storage location
+    only resume jobs whose owner stopped.
+    """
+
+    def __init__(self, storage_location: str) -> None:
+        self.storage_location = storage_location
+        # Start time included, a restarted process may get the same PID
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{int(time.time())}"
+        self.owner_lock = get_lock(storage_location, OWNER_LOCK_PREFIX + self.owner)
+        self.owner_lock.acquire()
+        self.db_path = os.path.join(storage_location, JOBS_DB_FILENAME)
+        self.conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                options TEXT NOT NULL,
+                created REAL NOT NULL,
+                owner TEXT
+            )"""
+        )
+        # Jobs of databases created before owners were recorded count as orphaned
+        if "owner" not in [row["name"] for row in self.conn.execute("PRAGMA table_info(jobs)")]:
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS job_songs (
+                job_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                song TEXT NOT NULL,
+                state TEXT NOT NULL,
+                PRIMARY KEY (job_id, position)
+            )"""
+        )
+        # Songs being processed by each process, kept from eviction by every process
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS pins (
+                youtube_id TEXT NOT NULL,
+                owner TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (youtube_id, owner)
+            )"""
+        )
+        self.conn.commit()
+
+    def create_job(self, chat_id, options: dict) -> int:
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO jobs (chat_id, options, created, owner) VALUES (?, ?, ?, ?)",
+                (chat_id, json.dumps(options), time.time(), self.owner),
+            )
+        return cursor.lastrowid
+
+    def add_songs(self, job_id: int, songs: dict):
+        """songs maps positions to Song objects"""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO job_songs VALUES (?, ?, ?, ?)",
+                [
+                    (job_id, position, json.dumps(song.to_dict()), PENDING)
+                    for position, song in songs.items()
+                ],
+            )
+
+    def update_song(self, job_id: int, position: int, song: Song, state: str):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE job_songs SET song = ?, state = ? WHERE job_id = ? AND position = ?",
+                (json.dumps(song.to_dict()), state, job_id, position),
+            )
+
+    def finish_job(self, job_id: int):
+        with self.conn:
+            self.conn.execute("DELETE FROM job_songs WHERE job_id = ?", (job_id,))
+            self.conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def jobs(self):
+        return [
+            {**dict(row), "options": json.loads(row["options"])}
+            for row in self.conn.execute("SELECT * FROM jobs ORDER BY id")
+        ]
+
+    def unsent_songs(self, job_id: int) -> dict:
+        """Positions of the songs not sent yet, mapped to the songs"""
+        rows = self.conn.execute(
+            "SELECT position, song FROM job_songs WHERE job_id = ? AND state != ? ORDER BY position",
+            (job_id, SENT),
+        )
+        return {row["position"]: Song.from_dict(json.loads(row["song"])) for row in rows}
+
+    def is_owner_running(self, owner: str) -> bool:
+        if owner is None:
+            return False
+        if owner == self.owner:
+            return True
+        lock = get_lock(self.storage_location, OWNER_LOCK_PREFIX + owner)
+        if not lock.acquire(blocking=False):
+            return True
+        lock.release()
+        os.remove(lock.path)
+        return False
+
+    def clear_stopped_owners(self):
+        """Remove the owner locks left by stopped processes, one is created per process start"""
+        lock_dir = os.path.join(self.storage_location, LOCK_DIR_NAME)
+        with get_lock(self.storage_location, "jobs"):
+            for filename in os.listdir(lock_dir):
+                if filename.startswith(OWNER_LOCK_PREFIX) and filename.endswith(".lock"):
+                    self.is_owner_running(filename[len(OWNER_LOCK_PREFIX):-len(".lock")])
+
+    def claim_orphaned_job(self, job_id: int):
+        """
+        Take over a job whose owner stopped, returns its unsent songs by position.
+        The job stays recorded under this process until the resumed batch finishes it.
+        None if the job is gone, its owner is still running or nothing is left to send.
+        """
+        with get_lock(self.storage_location, "jobs"):
+            row = self.conn.execute("SELECT owner FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or self.is_owner_running(row["owner"]):
+                return None
+            songs = self.unsent_songs(job_id)
+            if len(songs) == 0:
+                self.finish_job(job_id)
+                return None
+            with self.conn:
+                self.conn.execute("UPDATE jobs SET owner = ? WHERE id = ?", (self.owner, job_id))
+            return songs
+
+    def pin(self, youtube_id: str):
+        with self.conn:
+            self.conn.execute(
+                """INSERT INTO pins VALUES (?, ?, 1)
+                ON CONFLICT (youtube_id, owner) DO UPDATE SET count = count + 1""",
+                (youtube_id, self.owner),
+            )
+
+    def unpin(self, youtube_id: str):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE pins SET count = count - 1 WHERE youtube_id = ? AND owner = ?",
+                (youtube_id, self.owner),
+            )
+            self.conn.execute("DELETE FROM pins WHERE count <= 0")
+
+    def pinned_ids(self) -> set:
+        """YouTube IDs pinned by running processes, pins left by stopped ones are dropped. Blocking"""
+        with get_lock(self.storage_location, "jobs"):
+            owners = [row[0] for row in self.conn.execute("SELECT DISTINCT owner FROM pins")]
+            stopped_owners = [owner for owner in owners if not self.is_owner_running(owner)]
+            with self.conn:
+                self.conn.executemany(
+                    "DELETE FROM pins WHERE owner = ?", [(owner,) for owner in stopped_owners]
+                )
+            return set([row[0] for row in self.conn.execute("SELECT youtube_id FROM pins")])
+
+    def database_filenames(self):
+        return [JOBS_DB_FILENAME, JOBS_DB_FILENAME + "-wal", JOBS_DB_FILENAME + "-shm"]
+
+
+job_stores = {}
+
+
+def get_job_store(storage_location: str) -> JobStore:
+    if storage_location not in job_stores:
+        job_stores[storage_location] = JobStore(storage_location)
+    return job_stores[storage_location]
@@ -0,0 +1,61 @@
+import os
+import json
+import fcntl
+import tempfile
+
+LOCK_DIR_NAME = "locks"
+
+
+class FileLock:
+    """
+    Advisory lock on a file, held across the processes sharing the storage location on one host.
+    Blocking, acquire it off the event loop when it may be contended for long.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.fd = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Returns False if blocking is False and another process holds the lock"""
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(self.fd)
+            self.fd = None
+            return False
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def get_lock(storage_location: str, name: str) -> FileLock:
+    lock_dir = os.path.join(storage_location, LOCK_DIR_NAME)
+    os.makedirs(lock_dir, exist_ok=True)
+    return FileLock(os.path.join(lock_dir, name + ".lock"))
+
+
+def write_json_atomic(path: str, data, **kwargs):
+    """Readers see either the previous or the new file, never a partial write"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, **kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
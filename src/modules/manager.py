@@ -2,12 +2,14 @@ import asyncio
 import os
 import time
 from typing import List, Tuple
+from contextlib import ExitStack
 
 from traceback import format_exception
 
 from telegram.constants import ChatAction
 from telegram.ext import CallbackContext
 from telegram import Bot, Message, Update, InputMediaDocument, InputMediaAudio
+from telegram.error import BadRequest
 
 from constants import (
     SPOTIFY_ALBUM,
@@ -17,10 +19,28 @@ from constants import (
     YOUTUBE_SHORT,
 )
 
-from modules.spotify import Spotify
+from modules.spotify import Spotify, get_spotify
 from modules.song import Song
 from modules.downloader import Downloader
+from modules.resolver import BatchResolver
+from modules.eviction import EvictionEngine, get_eviction_engine
+from modules.job_store import get_job_store, RESOLVED, DOWNLOADED, SENT, FAILED as JOB_FAILED
 from modules.storage import Storage
+from modules.scheduler import scheduler, PRIORITY_SINGLE, PRIORITY_BULK
+from modules.singleflight import SingleFlight
+from modules.archive import ZipArchive, EntryTooLarge
+from modules.status import status_updater
+from modules.metrics import upload_seconds
+from modules.tracing import summarize_batch, get_slow_entry
+from modules.progress import (
+    BatchProgress,
+    SEARCHING,
+    WAITING,
+    DOWNLOADING,
+    UPLOADING,
+    DONE,
+    FAILED,
+)
 
 SPOTIFY_CLIENT_ID = os.environ.get("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.environ.get("SPOTIFY_CLIENT_SECRET")
@@ -31,18 +51,62 @@ if not os.path.exists(DOWNLOAD_PATH):
     os.mkdir(DOWNLOAD_PATH)
     print("path:" + DOWNLOAD_PATH + " created successfully")
 
+# Telegram albums hold at most 10 items
+MEDIA_GROUP_SIZE = 10
+
+# Shared by all chats, keyed on YouTube ID
+download_flights = SingleFlight()
+# Batches restarted by resume_jobs, stopped by stop_resumed_jobs
+resumed_tasks = set()
+
 
 class Manager:
     def __init__(
         self, update: Update, context: CallbackContext, upload: bool = True
     ) -> None:
-        self.download_sem = asyncio.BoundedSemaphore(5)
+        self.priority = PRIORITY_SINGLE
         self.update = update
         self.context = context
+        # Jobs resumed after a restart have no update, see Manager.from_chat
+        self.bot: Bot = context.bot if context is not None else None
+        self.chat_id = update.effective_chat.id if update is not None else None
         self.upload_song_to_chat = upload
         self.combine_files = False
+        self.archive: ZipArchive = None
+        self.group_uploads = False
+        self.completed_songs: asyncio.Queue = None
+        self.progress: BatchProgress = None
+        self.resolver: BatchResolver = None
+        # Remaining pages of playlists and albums, consumed while the first songs download
+        self.song_streams = []
+        self.streamed_song_count = 0
         self.storage = Storage(storage_location=DOWNLOAD_PATH)
-        self.spotify = Spotify(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET)
+        self.eviction: EvictionEngine = get_eviction_engine(DOWNLOAD_PATH)
+        self.pinned_ids = []
+        # Durable record of the batch, positions of its songs in the job
+        self.job_id = None
+        self.job_positions = {}
+        # Job and positions taken over by resume, used by the next process_songs
+        self.resumed_job = None
+        self.spotify: Spotify = get_spotify(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET)
+
+    def from_chat(bot: Bot, chat_id, upload: bool = True):
+        manager = Manager(None, None, upload)
+        manager.bot = bot
+        manager.chat_id = chat_id
+        return manager
+
+    async def resume(self, job_id: int, positions: dict):
+        """Continue a job left by a stopped process, positions map to its unsent songs"""
+        songs = list(positions.values())
+        self.resumed_job = (job_id, {song: position for position, song in positions.items()})
+        try:
+            msg = await self.interact(
+                text=f"Resuming {len(songs)} song(s) interrupted by a restart"
+            )
+            await self.process_songs(songs, msg)
+        except Exception as e:
+            print("Resuming job failed:", "".join(format_exception(None, e, e.__traceback__)))
 
     async def initialize_media(
         self, possible_links: List[str] = None, query: str = None
@@ -55,86 +119,187 @@ class Manager:
         else:
             for link in possible_links:
                 if SPOTIFY_TRACK in link:
-                    songs += [self.spotify.get_song(song_link=link)]
+                    songs += [await asyncio.to_thread(self.spotify.get_song, song_link=link)]
                 elif SPOTIFY_PLAYLIST in link:
-                    songs += self.spotify.get_playlist(playlist_link=link)
+                    first_songs, song_stream, total = await self.spotify.stream_playlist(playlist_link=link)
+                    songs += first_songs
+                    self.song_streams.append(song_stream)
+                    self.streamed_song_count += total - len(first_songs)
                     self.combine_files = True
                     self.upload_song_to_chat = False
                 elif SPOTIFY_ALBUM in link:
-                    songs += self.spotify.get_album(album_link=link)
+                    first_songs, song_stream, total = await self.spotify.stream_album(album_link=link)
+                    songs += first_songs
+                    self.song_streams.append(song_stream)
+                    self.streamed_song_count += total - len(first_songs)
                 elif (YOUTUBE_VIDEO in link) or (YOUTUBE_SHORT in link):
                     songs += [Song.from_youtube_link(youtube_link=link)]
         songs = [song for song in songs if song is not None]
+        song_count = len(songs) + self.streamed_song_count
         if len(songs) > 0:
-            msg = await self.interact(msg=msg, text=f"Processing {len(songs)} song(s)")
-        if len(songs) >= 5: # If more songs, send a zip
-            self.combine_files = True
+            msg = await self.interact(msg=msg, text=f"Processing {song_count} song(s)")
+        if song_count >= 5 and not self.combine_files:
+            if self.upload_song_to_chat:
+                # Send media groups while the remaining songs download
+                self.group_uploads = True
+            else:  # If more songs, send a zip
+                self.combine_files = True
             self.upload_song_to_chat = False
         return (songs, msg)
 
-    async def process_songs(self, songs: List[Song], prev_msg: Message = None):
+    def track_songs(self, songs: List[Song]):
+        positions = {}
+        for song in songs:
+            # Resumed jobs only hold the positions of their unsent songs
+            position = max(self.job_positions.values(), default=-1) + 1
+            positions[position] = song
+            self.job_positions[song] = position
+        self.storage.jobs.add_songs(self.job_id, positions)
+
+    def set_job_state(self, song: Song, state: str):
+        if self.job_id is not None and song in self.job_positions:
+            self.storage.jobs.update_song(self.job_id, self.job_positions[song], song, state)
+
+    def get_job_options(self) -> dict:
+        return {
+            "upload": self.upload_song_to_chat,
+            "combine": self.combine_files,
+            "group_uploads": self.group_uploads,
+        }
 
-        self.storage.clear_outdated()
+    async def process_songs(self, songs: List[Song], prev_msg: Message = None):
 
-        msg = await self.interact(
-            msg=prev_msg, text="Downloading {} song(s)".format(len(songs))
+        batch_start = time.monotonic()
+        if self.resumed_job is not None:
+            self.job_id, self.job_positions = self.resumed_job
+            self.resumed_job = None
+        else:
+            self.job_id = self.storage.jobs.create_job(self.chat_id, self.get_job_options())
+            self.job_positions = {}
+            self.track_songs(songs)
+        self.priority = PRIORITY_SINGLE if len(songs) + self.streamed_song_count == 1 else PRIORITY_BULK
+        if self.combine_files:
+            self.archive = ZipArchive(
+                name=None if songs[0].playlist is None else songs[0].playlist + ".zip",
+                on_part=self.upload_archive_part,
+            )
+        upload_task = None
+        if self.combine_files or self.group_uploads:
+            self.completed_songs = asyncio.Queue()
+            upload_task = asyncio.create_task(self.upload_stage())
+
+        self.progress = BatchProgress(
+            "Downloading {} song(s)".format(len(songs) + self.streamed_song_count) if songs[0].playlist is None
+            else "Downloading {}".format(songs[0].playlist),
+            songs,
         )
+        msg = await self.interact(msg=prev_msg, text=self.progress.render())
+        self.resolver = BatchResolver(DOWNLOAD_PATH)
+        self.resolver.add(songs)
 
         tasks = set()
-        for song in songs:
+        all_tasks = []
+
+        def start_song(song: Song):
             task = asyncio.create_task(self.process_song(song))
             tasks.add(task)
+            all_tasks.append(task)
             task.add_done_callback(tasks.discard)
 
-        task_exec_future = asyncio.gather(*tasks)
-        n_active_tasks = lambda: sum([not t.done() for t in tasks])
+        async def consume_streams():
+            while len(self.song_streams) > 0:
+                async for song in self.song_streams.pop(0):
+                    songs.append(song)
+                    self.progress.add(song)
+                    self.track_songs([song])
+                    self.resolver.add([song])
+                    start_song(song)
+
+        for song in songs:
+            start_song(song)
+        stream_task = asyncio.create_task(consume_streams())
+        tasks.add(stream_task)
+        stream_task.add_done_callback(tasks.discard)
+
+        cancelled = False
         try:
-            while n_active_tasks() > 0:
-                await asyncio.sleep(1)
-                if len(songs) > 1:
+            try:
+                # One message for the whole batch, refreshed while songs progress
+                while len(tasks) > 0:
+                    await asyncio.wait(tasks, timeout=2)
                     msg = await self.interact(
                         msg=msg,
-                        text="Remaining songs {}/{}".format(
-                            n_active_tasks(), len(songs)
-                        ),
+                        text=self.progress.render(),
                         action=ChatAction.TYPING,
                     )
-        except:
-            print("Updating failed!")
-
-        # Ensuring completion of threads
-        await task_exec_future
-
-        if self.upload_song_to_chat:
-            incomplete_songs = [
-                song for song in songs if song.message != "Upload completed"
-            ]
-        else:
-            incomplete_songs = [
-                song for song in songs if song.message != "Download completed"
-            ]
-
-        # retry_msg = None
-        # if len(incomplete_songs) > 0:
-        #     retry_msg = await self.interact(
-        #         text="Retrying {} songs".format(len(incomplete_songs))
-        #     )
-
-        if self.combine_files:
-            msg = await self.interact(
-                msg=msg,
-                text="Uploading {} songs".format(len(songs) - len(incomplete_songs)),
-                action=ChatAction.UPLOAD_DOCUMENT,
-                filename=self.storage.get_zipped([song.filename for song in songs if song.message == "Download completed"]),
-                filename_rename=None if songs[0].playlist is None else songs[0].playlist + ".zip",
-                # group_filenames=[self.storage.get_filepath(song.filename) for song in songs  if song.message == "Download completed"],
-            )
-        else:
+            except Exception:
+                # Cancellation by shutdown propagates to the job handling below
+                print("Updating failed!")
+
+            # Ensuring completion of threads
+            try:
+                await stream_task
+            except Exception as e:
+                print("Fetching remaining songs failed:", "".join(format_exception(None, e, e.__traceback__)))
+            await asyncio.gather(*all_tasks)
+            print("Batch resolution -", self.resolver.summary())
+            if upload_task is not None:
+                await self.completed_songs.put(None)
+                await upload_task
+
+            def get_incomplete_songs():
+                if self.upload_song_to_chat or self.group_uploads:
+                    return [song for song in songs if song.message != "Upload completed"]
+                return [song for song in songs if song.message != "Download completed"]
+
+            incomplete_songs = get_incomplete_songs()
+
+            # retry_msg = None
+            # if len(incomplete_songs) > 0:
+            #     retry_msg = await self.interact(
+            #         text="Retrying {} songs".format(len(incomplete_songs))
+            #     )
+
+            if self.combine_files:
+                # Songs were added to the archive as they finished, full parts are already sent
+                msg = await self.interact(
+                    msg=msg,
+                    text="Uploading {} songs".format(len(songs) - len(incomplete_songs)),
+                    action=ChatAction.UPLOAD_DOCUMENT,
+                    # group_filenames=[self.storage.get_filepath(song.filename) for song in songs  if song.message == "Download completed"],
+                )
+                await self.archive.close()
+                # Songs of a last part that failed to upload are failed now
+                incomplete_songs = get_incomplete_songs()
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            # Searches of a batch torn down early would otherwise keep running
+            self.resolver.cancel()
+            # Pins are released even if the batch failed, or its songs could never be evicted
+            for youtube_id in self.pinned_ids:
+                self.eviction.unpin(youtube_id)
+            self.pinned_ids = []
+            # Batches interrupted by a shutdown are kept for resume_jobs, failed ones are done
+            if not cancelled:
+                self.storage.jobs.finish_job(self.job_id)
+        print("Batch timing -", summarize_batch(songs, time.monotonic() - batch_start))
+        try:
+            await self.storage.add_to_slowlog([get_slow_entry(song, self.chat_id) for song in songs])
+        except Exception as e:
+            print("Updating slow request log failed:", e)
+        failed_names = "".join(
+            ["\n❌ " + str(song.get_display_name()) for song in self.progress.get_failed()]
+        )
+        if not self.combine_files:
             await self.interact(
                 text="Downloaded {}/{} songs".format(
                     len(songs) - len(incomplete_songs), len(songs)
-                )
+                ) + failed_names
             )
+        elif len(failed_names) > 0:
+            await self.interact(text="Download failed for:" + failed_names)
 
         print(
             "Songs' final Message:\n\t",
@@ -143,82 +308,86 @@ class Manager:
             ),
         )
         
-        await msg.delete()
+        await status_updater.delete(msg)
 
-        self.storage.save_index()
         return incomplete_songs
 
     async def process_song(self, song: Song):
 
-        await self.download_sem.acquire()
         log_fn = song.add_log
-        msg = None
+        song.trace.start()
         try:
             # Update YouTube data
+            self.progress.set_state(song, SEARCHING)
             downloader = Downloader(DOWNLOAD_PATH, logger=log_fn)
-            await downloader.retrieve_youtube_id(song)
-            
+            with song.trace.span("resolve"):
+                await self.resolver.resolve(song)
+            # Songs without a YouTube ID must not reach the download flights, they're keyed on it
+            if song.youtube_id is None:
+                song.message = "Search failed"
+                log_fn("Search failed: " + str(song.get_display_name()))
+                raise Exception("Search failed")
+            # Keep the song's file from eviction until the batch is sent
+            self.pinned_ids.append(song.youtube_id)
+            self.eviction.pin(song.youtube_id)
+            self.set_job_state(song, RESOLVED)
+
             if song.query is not None:
                 log_fn(f"Searching: {song.query}")
             
             log_fn(f"Started: {song.get_display_name()}\tRetreived YouTube ID: {song.youtube_id}")
-            msg = await self.interact(
-                text="Searching: " + song.get_display_name(), action=ChatAction.TYPING
-            )
+
+            # Reuse a previous upload, this works even if the local file was cleared
+            if self.upload_song_to_chat and self.storage.get_file_id(song) is not None:
+                self.progress.set_state(song, UPLOADING)
+                with song.trace.span("upload"):
+                    uploaded = await self.upload_song(song)
+                if uploaded:
+                    song.message = "Upload completed"
+                    self.storage.record_access(song)
+                    self.set_job_state(song, SENT)
+                    log_fn("Uploaded from file_id: " + song.get_display_name())
+                    self.progress.set_state(song, DONE)
+                    return
 
             # Check Index for pre-downloaded files
-            if self.storage.find_file(song):
+            if await self.storage.find_file(song):
                 log_fn("Indexed file found: " + str(self.storage.get_index(song)))
+            elif self.group_uploads and self.storage.get_file_id(song) is not None:
+                # Evicted but uploaded before, the group sends it by file_id
+                song.filename = self.storage.get_indexed_filename(song)
+                song.message = "Download completed"
+                log_fn("Grouping by file_id: " + song.get_display_name())
+                self.storage.record_access(song)
+                self.set_job_state(song, DOWNLOADED)
+                await self.completed_songs.put(song)
+                return
             else:
                 # Ensure storage availability
                 # self.storage.clear_uploaded()
 
-                # Initiate Download
+                # Initiate Download, the job itself signals completion
                 if song.retry_count < downloader.max_retries:
-                    log_fn("Downloader try: " + str(song.retry_count))
-                    await downloader.download(song, self.storage.get_filepath(song.filename))
+                    if download_flights.in_flight(song.youtube_id):
+                        log_fn("Joining in-flight download: " + song.youtube_id)
+                        self.progress.set_state(song, DOWNLOADING)
+                    else:
+                        self.progress.set_state(song, WAITING)
+                    with song.trace.span("download"):
+                        downloaded, song.filename, song.codec, song.content_hash = await download_flights.run(
+                            song.youtube_id, lambda: self.download_song(song, downloader)
+                        )
+                    song.message = "Download started" if downloaded else "Download couldn't start"
 
                 # Verify Initiation
                 if song.message == "Download couldn't start":
                     log_fn("Download couldn't start: " + song.get_display_name())
-                    msg = await self.interact(
-                        msg=msg,
-                        text="Download couldn't start: " + song.get_display_name(),
-                        action=ChatAction.TYPING,
-                    )
                     raise Exception("Download couldn't start")
-                elif song.message == "Download started":
-                    log_fn("Download started: " + song.get_display_name())
-                    msg = await self.interact(
-                        msg=msg,
-                        text="Download started: " + song.get_display_name(),
-                        action=ChatAction.TYPING,
-                    )
-
-                # Download Timeout
-                start_time = time.time()
-                time_emojis = ["🕛","🕐","🕑","🕒","🕓","🕔","🕕","🕖","🕗","🕘","🕙","🕚",]
-                time_emoji_ind = 0
-                while not self.storage.find_file(song):
-                    if time.time() - start_time >= 300:  # Timeout of 5 mins
-                        break
-                    msg = await self.interact(
-                        msg=msg,
-                        text=f"Downloading ({time_emojis[time_emoji_ind]}) : {song.get_display_name()}",
-                        action=ChatAction.TYPING,
-                    )
-                    await asyncio.sleep(2)
-                    time_emoji_ind = (time_emoji_ind + 1) % len(time_emojis)
 
-            # Verify completion
-            if not self.storage.find_file(song):
+            # Verify completion, song.filename is the indexed name or the one the download was linked under
+            if not self.storage.has_song_file(song):
                 song.message = "Download couldn't complete"
                 log_fn("Download couldn't complete: " + song.get_display_name())
-                msg = await self.interact(
-                    msg=msg,
-                    text="Download couldn't complete: " + song.get_display_name(),
-                    action=ChatAction.TYPING,
-                )
                 raise Exception("Download couldn't complete")
 
             # Succesful Download - Rename and add to index
@@ -226,64 +395,248 @@ class Manager:
             song.message = "Download completed"
             log_fn("Download completed: " + song.get_display_name())
             self.storage.update_index(song)
+            self.storage.record_access(song)
             log_fn("Index Updated: " + song.get_display_name())
-            msg = await self.interact(
-                msg=msg,
-                text="Download completed: " + song.get_display_name(),
-            )
+            # Cache only batches are complete once downloaded
+            sending = self.upload_song_to_chat or self.group_uploads or self.combine_files
+            self.set_job_state(song, DOWNLOADED if sending else SENT)
+            if self.completed_songs is not None:
+                await self.completed_songs.put(song)
+            if not self.group_uploads:
+                self.progress.set_state(song, DONE)
 
             # Send to TG servers
             if self.upload_song_to_chat:
-                msg = await self.interact(
-                    msg=msg,
-                    text="Uploading: " + song.get_display_name(),
-                    action=ChatAction.UPLOAD_DOCUMENT,
-                    filename=self.storage.get_filepath(song.filename),
-                )
-                self.storage.mark_uploaded(song)
+                self.progress.set_state(song, UPLOADING)
+                with song.trace.span("upload"):
+                    await self.upload_song(song, allow_reupload=True)
                 song.message = "Upload completed"
+                self.set_job_state(song, SENT)
                 log_fn("Uploaded: " + song.get_display_name())
-            self.storage.save_index()
-            await msg.delete()
+                self.progress.set_state(song, DONE)
         except Exception as e:
             exception_string = "".join(format_exception(
                 None, e, e.__traceback__
             ))
             log_fn("Exception:", exception_string)
             song_logs = song.get_logs()
+            song_logs += f"\nTiming: {song.trace.describe()}"
             song_logs += f"\nException:\n{exception_string}"
             print(
                 f"Thread failed for Song: {song.get_display_name()}\nLogs:\n{song_logs}"
             )
             await self.storage.add_to_logfile(song_logs)
-            msg = await self.interact(
-                msg=msg,
-                text="Download failed for: " + song.get_display_name(),
-                action=ChatAction.TYPING,
-            )
-        finally:
-            self.download_sem.release()
+            self.progress.set_state(song, FAILED)
+            self.set_job_state(song, JOB_FAILED)
 
         return
 
+    async def download_song(self, song: Song, downloader: Downloader):
+        """Returns whether the download succeeded with the resulting filename, codec and content hash"""
+        async with scheduler.slot(
+            self.chat_id, song.get_display_name(), self.priority
+        ):
+            song.add_log("Downloader try: " + str(song.retry_count))
+            self.progress.set_state(song, DOWNLOADING)
+            display_filename = song.filename
+            downloaded = await downloader.download(song, self.storage.get_incoming_path(song))
+            if downloaded:
+                await asyncio.to_thread(self.storage.store_download, song, display_filename)
+            return downloaded, song.filename, song.codec, song.content_hash
+
+    async def upload_song(self, song: Song, allow_reupload: bool = False) -> bool:
+        """
+        Send by the stored Telegram file_id when available, otherwise upload the local file.
+        Returns False if only a file_id upload was allowed and Telegram rejected it.
+        """
+        file_id = self.storage.get_file_id(song)
+        if file_id is not None:
+            try:
+                await self.send_document(file_id)
+                self.storage.mark_uploaded(song, file_id)
+                return True
+            except BadRequest as e:
+                song.add_log("Stored file_id rejected: " + str(e))
+                self.storage.mark_uploaded(song, None)
+        if not allow_reupload:
+            return False
+        with open(self.storage.get_filepath(song.filename), "rb") as document:
+            sent = await self.send_document(document, filename=song.filename)
+        self.storage.mark_uploaded(song, sent.effective_attachment.file_id)
+        return True
+
+    async def upload_stage(self):
+        """Consumes completed songs while downloads are still running, None marks the end"""
+        group = []
+        while True:
+            song = await self.completed_songs.get()
+            if song is not None and self.archive is not None:
+                try:
+                    with song.trace.span("zip"):
+                        await self.archive.add(self.storage.get_filepath(song.filename), song.filename)
+                except EntryTooLarge as e:
+                    print("Archiving skipped:", e)
+                    self.fail_songs([song], "Too large to send")
+                except Exception as e:
+                    print("Archiving failed:", "".join(format_exception(None, e, e.__traceback__)))
+                    self.fail_songs([song], "Archiving failed")
+                continue
+            if song is not None:
+                group.append(song)
+            if len(group) == MEDIA_GROUP_SIZE or (song is None and len(group) > 0):
+                await self.upload_group(group)
+                group = []
+            if song is None:
+                return
+
+    async def upload_group(self, songs: List[Song]):
+        start = time.monotonic()
+        for song in songs:
+            self.progress.set_state(song, UPLOADING)
+        try:
+            await status_updater.send_action(
+                self.bot, self.chat_id, ChatAction.UPLOAD_DOCUMENT
+            )
+            if len(songs) == 1:
+                await self.upload_song(songs[0], allow_reupload=True)
+                sent_songs = songs
+            else:
+                sent_songs = await self.send_group(songs)
+            for song in sent_songs:
+                song.trace.add("upload", time.monotonic() - start, start)
+                song.message = "Upload completed"
+                self.set_job_state(song, SENT)
+                song.add_log("Uploaded in group: " + song.get_display_name())
+                self.progress.set_state(song, DONE)
+            self.fail_songs([song for song in songs if song not in sent_songs], "Upload failed")
+        except Exception as e:
+            print("Group upload failed:", "".join(format_exception(None, e, e.__traceback__)))
+            for song in songs:
+                self.progress.set_state(song, FAILED)
+
+    async def send_group(self, songs: List[Song]) -> List[Song]:
+        """
+        Send songs as one media group, returns the songs that were sent.
+        If Telegram rejects a stored file_id, e.g. one of a Document, songs with a local file
+        are uploaded again and evicted songs are sent alone by their file_id.
+        """
+        with ExitStack() as stack:
+            try:
+                messages = await self.send_media_group(
+                    self.get_group_media(songs, stack, use_file_ids=True)
+                )
+                self.mark_group_uploaded(songs, messages)
+                return songs
+            except BadRequest as e:
+                print("Media group with stored file_ids rejected:", e)
+
+        local_songs = [song for song in songs if self.storage.has_song_file(song)]
+        sent_songs = []
+        if len(local_songs) > 1:
+            with ExitStack() as stack:
+                messages = await self.send_media_group(
+                    self.get_group_media(local_songs, stack, use_file_ids=False)
+                )
+            self.mark_group_uploaded(local_songs, messages)
+            sent_songs.extend(local_songs)
+        elif len(local_songs) == 1:
+            await self.upload_song(local_songs[0], allow_reupload=True)
+            sent_songs.extend(local_songs)
+        for song in songs:
+            if song in local_songs:
+                continue
+            try:
+                if await self.upload_song(song):
+                    sent_songs.append(song)
+            except Exception as e:
+                print("Sending by file_id failed:", e)
+        return sent_songs
+
+    def mark_group_uploaded(self, songs: List[Song], messages: List[Message]):
+        for song, message in zip(songs, messages):
+            self.storage.mark_uploaded(song, message.effective_attachment.file_id)
+
+    def fail_songs(self, songs: List[Song], message: str):
+        """Fail songs that already counted as completed, so the batch reports them"""
+        for song in songs:
+            song.message = message
+            self.progress.set_state(song, FAILED)
+            self.set_job_state(song, JOB_FAILED)
+
+    def get_group_media(self, songs: List[Song], stack: ExitStack, use_file_ids: bool):
+        media = []
+        for song in songs:
+            file_id = self.storage.get_file_id(song) if use_file_ids else None
+            if file_id is None:
+                file_id = stack.enter_context(open(self.storage.get_filepath(song.filename), "rb"))
+            media.append(InputMediaAudio(file_id, filename=song.filename))
+        return media
+
+    async def send_media_group(self, media) -> List[Message]:
+        server_bot: Bot = self.bot
+        start = time.monotonic()
+        messages = await status_updater.call(
+            self.chat_id,
+            server_bot.send_media_group,
+            chat_id=self.chat_id,
+            read_timeout=600,
+            write_timeout=600,
+            media=media,
+        )
+        upload_seconds.observe(time.monotonic() - start, kind="media_group")
+        return messages
+
+    async def upload_archive_part(self, path: str, filename: str, song_filenames: List[str]):
+        await status_updater.send_action(
+            self.bot, self.chat_id, ChatAction.UPLOAD_DOCUMENT
+        )
+        start = time.monotonic()
+        part_songs = [song for song in self.job_positions if song.filename in song_filenames]
+        try:
+            with open(path, "rb") as document:
+                await self.send_document(document, filename=filename)
+        except Exception as e:
+            # The part file is removed after this, its songs can't be sent anymore
+            print("Archive part upload failed:", "".join(format_exception(None, e, e.__traceback__)))
+            self.fail_songs(part_songs, "Upload failed")
+            return
+        for song in part_songs:
+            song.trace.add("upload", time.monotonic() - start, start)
+            self.set_job_state(song, SENT)
+
+    async def send_document(self, document, filename=None) -> Message:
+        server_bot: Bot = self.bot
+        start = time.monotonic()
+        message = await status_updater.call(
+            self.chat_id,
+            server_bot.send_document,
+            chat_id=self.chat_id,
+            read_timeout=600,
+            write_timeout=600,
+            document=document,
+            filename=filename,
+        )
+        upload_seconds.observe(time.monotonic() - start, kind="document")
+        return message
+
     async def interact(
         self, msg: Message = None, text=None, action=None, filename=None, filename_rename=None, group_filenames=None,
     ):
-        server_bot: Bot = self.context.bot
+        server_bot: Bot = self.bot
         # self.lock.acquire()
         if msg is not None:
-            if (text is not None) and (text != msg.text):
-                # print('Text:',text,'Msg.text:',msg.text)
-                msg = await msg.edit_text(text)
+            if text is not None:
+                # Coalesced and rate limited, returns before the edit is sent
+                status_updater.edit(msg, text)
         elif text is not None:
-            msg = await server_bot.send_message(
-                chat_id=self.update.effective_chat.id, text=text,
+            msg = await status_updater.send_message(
+                server_bot, self.chat_id, text,
                 disable_notification=True,
             )
 
         if action is not None:
-            await server_bot.send_chat_action(
-                chat_id=self.update.effective_chat.id, action=action
+            await status_updater.send_action(
+                server_bot, self.chat_id, action
             )
 
         # self.lock.release()
@@ -291,24 +644,44 @@ class Manager:
         if filename:
             if not filename_rename:
                 filename_rename = filename
-            document = open(filename, "rb")
-            await server_bot.send_document(
-                chat_id=self.update.effective_chat.id,
-                read_timeout=600,
-                write_timeout=600,
-                document=document,
-                filename=filename_rename,
-            )
+            with open(filename, "rb") as document:
+                await self.send_document(document, filename=filename_rename)
         if group_filenames:
-            media=[
-                InputMediaAudio(open(filename, "rb"))
-                for filename in group_filenames
-            ]
-            await server_bot.send_media_group(
-                chat_id=self.update.effective_chat.id,
-                read_timeout=600,
-                write_timeout=600,
-                media=media
-            )
+            with ExitStack() as stack:
+                media=[
+                    InputMediaAudio(stack.enter_context(open(filename, "rb")))
+                    for filename in group_filenames
+                ]
+                await self.send_media_group(media)
         # self.lock.release()
         return msg
+
+
+async def resume_jobs(bot: Bot):
+    """
+    Restart the batches left by stopped processes, without the songs already sent.
+    Batches of other bot processes still running on the storage location are left to them.
+    """
+    job_store = get_job_store(DOWNLOAD_PATH)
+    await asyncio.to_thread(job_store.clear_stopped_owners)
+    for job in job_store.jobs():
+        # The resumed batch keeps the job, it is finished once the batch is
+        positions = await asyncio.to_thread(job_store.claim_orphaned_job, job["id"])
+        if positions is None:
+            continue
+        print(f"Resuming job {job['id']} with {len(positions)} song(s) for chat {job['chat_id']}")
+        manager = Manager.from_chat(bot, job["chat_id"], upload=job["options"]["upload"])
+        manager.combine_files = job["options"]["combine"]
+        manager.group_uploads = job["options"]["group_uploads"]
+        # Started before the application runs, it would not track the task
+        task = asyncio.create_task(manager.resume(job["id"], positions))
+        resumed_tasks.add(task)
+        task.add_done_callback(resumed_tasks.discard)
+
+
+async def stop_resumed_jobs():
+    """Cancel the resumed batches still running, their jobs are kept for the next start"""
+    tasks = list(resumed_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
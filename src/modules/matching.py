@@ -0,0 +1,145 @@
+import os
+import re
+import math
+import unicodedata
+
+from modules.song import Song
+
+# A best match at or above this score skips the fallback search
+MATCH_CONFIDENT_SCORE = float(os.environ.get("MATCH_CONFIDENT_SCORE", 0.75))
+# Results requested by the first search and by the fallback search
+QUICK_RESULT_COUNT = int(os.environ.get("MATCH_QUICK_RESULTS", 5))
+FULL_RESULT_COUNT = 10
+# Duration difference in seconds at which the duration score drops to 0
+DURATION_TOLERANCE = 30
+
+WEIGHTS = {
+    "duration": 0.35,
+    "title": 0.3,
+    "artist": 0.15,
+    "channel": 0.15,
+    "views": 0.05,
+}
+# Versions users rarely want, unless the track itself is one of them
+PENALTY_TERMS = [
+    "live",
+    "cover",
+    "remix",
+    "karaoke",
+    "instrumental",
+    "acoustic",
+    "nightcore",
+    "slowed",
+    "sped up",
+    "reverb",
+    "8d",
+    "bass boosted",
+    "reaction",
+]
+PENALTY = 0.3
+# Words that carry no information about which song a title is
+STOP_WORDS = {
+    "the", "a", "an", "and", "of", "feat", "ft", "featuring", "official",
+    "audio", "video", "music", "lyrics", "lyric", "hd", "hq", "topic",
+}
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join([c for c in text if not unicodedata.combining(c)])
+    return re.sub(r"[^\w]+", " ", text.lower()).strip()
+
+
+def get_tokens(text: str) -> set:
+    return set([t for t in normalize(text).split() if t not in STOP_WORDS])
+
+
+def token_overlap(expected: set, found: set) -> float:
+    """Share of expected tokens present in found"""
+    if not expected:
+        return 0
+    return len(expected & found) / len(expected)
+
+
+def contains_term(text: str, term: str) -> bool:
+    return re.search(r"\b" + re.escape(term) + r"\b", normalize(text)) is not None
+
+
+def get_song_title(song: Song) -> str:
+    if song.name is not None:
+        return song.name
+    # Queries get " audio" appended, which is only a search hint
+    return song.query or ""
+
+
+def score_duration(song: Song, candidate: dict) -> float:
+    if song.duration is None or not candidate.get("duration"):
+        return 0.5
+    return max(0, 1 - abs(candidate["duration"] - song.duration) / DURATION_TOLERANCE)
+
+
+def score_channel(candidate: dict) -> float:
+    channel = candidate.get("channel") or candidate.get("uploader") or ""
+    # Auto-generated "Artist - Topic" channels carry the album audio
+    if channel.endswith(" - Topic"):
+        return 1
+    if candidate.get("channel_is_verified") or "vevo" in channel.lower():
+        return 0.6
+    return 0
+
+
+def score_views(candidate: dict) -> float:
+    views = candidate.get("view_count") or 0
+    # 1 billion views scores 1
+    return min(math.log10(views + 1) / 9, 1)
+
+
+def get_penalty(song: Song, candidate: dict) -> float:
+    title = candidate.get("title") or ""
+    song_title = get_song_title(song)
+    penalty = 0
+    for term in PENALTY_TERMS:
+        if contains_term(title, term) and not contains_term(song_title, term):
+            penalty += PENALTY
+    if candidate.get("live_status") in ("is_live", "was_live") and not contains_term(song_title, "live"):
+        penalty += PENALTY
+    return penalty
+
+
+def score_candidate(song: Song, candidate: dict) -> float:
+    """Roughly 0 to 1, higher is a better match for the song"""
+    title_tokens = get_tokens(candidate.get("title"))
+    channel_tokens = get_tokens(candidate.get("channel") or candidate.get("uploader"))
+    artist_tokens = get_tokens(" ".join(song.artists))
+    scores = {
+        "duration": score_duration(song, candidate),
+        "title": token_overlap(get_tokens(get_song_title(song)), title_tokens),
+        # Artists without tokens (queries) are neutral
+        "artist": token_overlap(artist_tokens, title_tokens | channel_tokens) if artist_tokens else 0.5,
+        "channel": score_channel(candidate),
+        "views": score_views(candidate),
+    }
+    score = sum([WEIGHTS[k] * v for k, v in scores.items()])
+    return score - get_penalty(song, candidate)
+
+
+def get_best_match(song: Song, results: list):
+    """Returns the best scoring result with its score, (None, 0) without results"""
+    best_match, best_score = None, 0
+    for candidate in results:
+        if candidate is None:
+            continue
+        score = score_candidate(song, candidate)
+        if best_match is None or score > best_score:
+            best_match, best_score = candidate, score
+    return best_match, best_score
+
+
+def get_fallback_query(song: Song) -> str:
+    """
+    Plainer query than Song.get_search_query, used when the first search has no confident match.
+    None for query songs, their only query was searched already.
+    """
+    if song.name is None:
+        return None
+    return ", ".join(song.artists) + " - " + song.name
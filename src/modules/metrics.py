@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import asyncio
+
+from constants import TEMP_DIR
+from modules.locking import write_json_atomic
+
+# Each process writes its metrics here, the webshell process merges them for /metrics
+METRICS_DIR = os.path.join(TEMP_DIR, "metrics")
+METRICS_FLUSH_INTERVAL = int(os.environ.get("METRICS_FLUSH_INTERVAL", 10))
+# Snapshots of processes that stopped writing are dropped
+METRICS_STALE_SECONDS = 300
+
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+
+def get_label_key(labels: dict) -> str:
+    return json.dumps(labels, sort_keys=True)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self.values = {}  # label key -> value
+
+    def inc(self, amount: float = 1, **labels):
+        key = get_label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list:
+        return [{"labels": json.loads(k), "value": v} for k, v in self.values.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[get_label_key(labels)] = value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: list = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.values = {}  # label key -> {"counts", "sum", "count"}
+
+    def observe(self, value: float, **labels):
+        key = get_label_key(labels)
+        if key not in self.values:
+            self.values[key] = {"counts": [0] * len(self.buckets), "sum": 0, "count": 0}
+        histogram = self.values[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                histogram["counts"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+    def samples(self) -> list:
+        return [{"labels": json.loads(k), **v} for k, v in self.values.items()]
+
+
+class Registry:
+    """Metrics of this process, written to a snapshot file that the webshell renders"""
+
+    def __init__(self) -> None:
+        self.metrics = {}
+        self.collectors = []
+        self.task: asyncio.Task = None
+
+    def get_metric(self, metric_class, name: str, help: str, **kwargs):
+        if name not in self.metrics:
+            self.metrics[name] = metric_class(name, help, **kwargs)
+        return self.metrics[name]
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.get_metric(Counter, name, help)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self.get_metric(Gauge, name, help)
+
+    def histogram(self, name: str, help: str, buckets: list = LATENCY_BUCKETS) -> Histogram:
+        return self.get_metric(Histogram, name, help, buckets=buckets)
+
+    def add_collector(self, collector):
+        """collector() is called before every snapshot, to set gauges read from elsewhere"""
+        self.collectors.append(collector)
+
+    def snapshot(self) -> dict:
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                print("Metrics collector failed:", e)
+        return {
+            name: {
+                "type": metric.type,
+                "help": metric.help,
+                "buckets": getattr(metric, "buckets", None),
+                "samples": metric.samples(),
+            }
+            for name, metric in self.metrics.items()
+        }
+
+    def write_snapshot(self, process_name: str):
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"{process_name}-{os.getpid()}.json")
+        write_json_atomic(path, {"process": process_name, "metrics": self.snapshot()})
+
+    async def flush_forever(self, process_name: str, interval: int = METRICS_FLUSH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.write_snapshot(process_name)
+            except Exception as e:
+                print("Writing metrics failed:", e)
+
+    def start(self, process_name: str):
+        if self.task is None:
+            self.task = asyncio.create_task(self.flush_forever(process_name))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+def read_snapshots() -> list:
+    if not os.path.exists(METRICS_DIR):
+        return []
+    snapshots = []
+    for filename in os.listdir(METRICS_DIR):
+        path = os.path.join(METRICS_DIR, filename)
+        if not filename.endswith(".json"):
+            continue
+        try:
+            if time.time() - os.path.getmtime(path) > METRICS_STALE_SECONDS:
+                os.remove(path)
+                continue
+            with open(path, "r") as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join([f'{k}="{v}"' for k, v in sorted(labels.items())]) + "}"
+
+
+def render_metrics(snapshots: list) -> str:
+    """Prometheus text exposition of the snapshots, samples with equal labels are summed across processes"""
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot["metrics"].items():
+            merged_metric = merged.setdefault(
+                name, {"type": metric["type"], "help": metric["help"], "buckets": metric["buckets"], "samples": {}}
+            )
+            for sample in metric["samples"]:
+                key = get_label_key(sample["labels"])
+                if key not in merged_metric["samples"]:
+                    merged_metric["samples"][key] = json.loads(json.dumps(sample))
+                elif metric["type"] == "histogram":
+                    merged_sample = merged_metric["samples"][key]
+                    merged_sample["counts"] = [a + b for a, b in zip(merged_sample["counts"], sample["counts"])]
+                    merged_sample["sum"] += sample["sum"]
+                    merged_sample["count"] += sample["count"]
+                else:
+                    merged_metric["samples"][key]["value"] += sample["value"]
+
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for sample in metric["samples"].values():
+            labels = sample["labels"]
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{format_labels(labels)} {sample['value']}")
+                continue
+            # Bucket counts are stored per bucket already cumulative
+            for bound, count in zip(metric["buckets"], sample["counts"]):
+                lines.append(f"{name}_bucket{format_labels({**labels, 'le': bound})} {count}")
+            lines.append(f"{name}_bucket{format_labels({**labels, 'le': '+Inf'})} {sample['count']}")
+            lines.append(f"{name}_sum{format_labels(labels)} {sample['sum']}")
+            lines.append(f"{name}_count{format_labels(labels)} {sample['count']}")
+    return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# Pipeline metrics, shared by the modules that record them
+search_seconds = registry.histogram("search_seconds", "YouTube search time per song")
+resolution_lookups = registry.counter("resolution_cache_lookups_total", "Resolution cache lookups by result")
+download_seconds = registry.histogram("download_seconds", "Transfer time per download")
+transcode_seconds = registry.histogram("transcode_seconds", "Post-processing (FFmpeg) time per download")
+download_bytes = registry.counter("download_bytes_total", "Bytes transferred by downloads")
+downloads = registry.counter("downloads_total", "Downloads by result")
+upload_seconds = registry.histogram("upload_seconds", "Telegram upload time by kind")
+bot_api_calls = registry.counter("bot_api_calls_total", "Bot API calls made through the status updater")
+bot_api_retry_after = registry.counter("bot_api_retry_after_total", "Bot API flood control (429) responses")
+queue_depth = registry.gauge("queue_depth", "Jobs waiting or running by queue and state")
+worker_tasks = registry.counter("worker_tasks_total", "Broker tasks run by workers by function and result")
+worker_task_seconds = registry.histogram("worker_task_seconds", "Broker task run time on workers by function")
@@ -0,0 +1,81 @@
+from typing import List
+
+from modules.song import Song
+from modules.executor import get_progress
+
+QUEUED = "queued"
+SEARCHING = "searching"
+WAITING = "waiting"
+DOWNLOADING = "downloading"
+UPLOADING = "uploading"
+DONE = "done"
+FAILED = "failed"
+
+STATE_EMOJIS = {
+    QUEUED: "⏳",
+    SEARCHING: "🔍",
+    WAITING: "⏸",
+    DOWNLOADING: "⬇️",
+    UPLOADING: "⬆️",
+    DONE: "✅",
+    FAILED: "❌",
+}
+# Active and failed songs first, finished ones last
+STATE_ORDER = [DOWNLOADING, UPLOADING, SEARCHING, FAILED, WAITING, QUEUED, DONE]
+MAX_SONG_LINES = 25
+MAX_LINE_LENGTH = 80
+
+
+class BatchProgress:
+    """State of every song in a batch, rendered into a single status message"""
+
+    def __init__(self, title: str, songs: List[Song]) -> None:
+        self.title = title
+        self.songs = []
+        self.states = {}
+        for song in songs:
+            self.add(song)
+
+    def add(self, song: Song):
+        self.songs.append(song)
+        self.states[id(song)] = QUEUED
+
+    def set_state(self, song: Song, state: str):
+        self.states[id(song)] = state
+
+    def get_state(self, song: Song) -> str:
+        return self.states[id(song)]
+
+    def count(self, state: str) -> int:
+        return sum([s == state for s in self.states.values()])
+
+    def render_song(self, song: Song) -> str:
+        state = self.get_state(song)
+        name = str(song.get_display_name())
+        if len(name) > MAX_LINE_LENGTH:
+            name = name[: MAX_LINE_LENGTH - 1] + "…"
+        line = f"{STATE_EMOJIS[state]} {name}"
+        if state == DOWNLOADING:
+            progress = get_progress(song.youtube_id)
+            if progress is not None and progress["status"] == "finished":
+                line += " (converting)"
+            elif progress is not None and progress["downloaded"] and progress["total"]:
+                line += f" ({100 * progress['downloaded'] // progress['total']}%)"
+        return line
+
+    def render(self) -> str:
+        summary = " · ".join(
+            [
+                f"{STATE_EMOJIS[state]} {self.count(state)}"
+                for state in STATE_ORDER
+                if self.count(state) > 0
+            ]
+        )
+        ordered_songs = sorted(self.songs, key=lambda song: STATE_ORDER.index(self.get_state(song)))
+        lines = [self.render_song(song) for song in ordered_songs[:MAX_SONG_LINES]]
+        if len(ordered_songs) > MAX_SONG_LINES:
+            lines.append(f"… and {len(ordered_songs) - MAX_SONG_LINES} more")
+        return "\n".join([self.title, summary, ""] + lines)
+
+    def get_failed(self) -> List[Song]:
+        return [song for song in self.songs if self.get_state(song) == FAILED]
@@ -0,0 +1,126 @@
+import os
+import re
+import time
+import sqlite3
+
+from constants import TEMP_DIR
+from modules.song import Song
+from modules.metrics import resolution_lookups
+
+RESOLUTION_CACHE_FILENAME = "resolutions.db"
+RESOLUTION_CACHE_TTL = int(os.environ.get("RESOLUTION_CACHE_TTL_DAYS", 30)) * 24 * 3600
+RESOLUTION_CACHE_SIZE = int(os.environ.get("RESOLUTION_CACHE_SIZE", 5000))
+# Stays below SQLite's limit on bound parameters
+LOOKUP_CHUNK = 500
+
+
+def get_cache_key(song: Song):
+    if song.spotify_id is not None:
+        return "spotify:" + song.spotify_id
+    if song.query is not None:
+        return "query:" + re.sub(r"\s+", " ", song.query.strip().lower())
+    return None
+
+
+class ResolutionCache:
+    """
+    Persistent mapping of Spotify tracks and search queries to the chosen YouTube video.
+    Entries expire after a TTL and the least recently used ones are evicted beyond the size limit.
+    """
+
+    def __init__(self, path: str, ttl: int, max_entries: int) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.conn: sqlite3.Connection = None
+        self.hits = 0
+        self.misses = 0
+
+    def get_connection(self) -> sqlite3.Connection:
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS resolutions (
+                    key TEXT PRIMARY KEY,
+                    youtube_id TEXT NOT NULL,
+                    filename TEXT,
+                    duration REAL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )"""
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS resolutions_last_used ON resolutions (last_used)"
+            )
+            self.conn.commit()
+        return self.conn
+
+    def lookup_many(self, songs: list) -> list:
+        """Fill the songs' YouTube fields from the cache with one query per LOOKUP_CHUNK keys, returns the hits"""
+        keyed_songs = {}
+        for song in songs:
+            key = get_cache_key(song)
+            if key is not None:
+                keyed_songs.setdefault(key, []).append(song)
+        keys = list(keyed_songs)
+        conn = self.get_connection()
+        now = time.time()
+        hits = []
+        for i in range(0, len(keys), LOOKUP_CHUNK):
+            chunk = keys[i : i + LOOKUP_CHUNK]
+            rows = conn.execute(
+                f"""SELECT key, youtube_id, filename, duration FROM resolutions
+                WHERE key IN ({",".join("?" * len(chunk))}) AND created > ?""",
+                (*chunk, now - self.ttl),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE resolutions SET last_used = ? WHERE key = ?", [(now, row[0]) for row in rows]
+            )
+            for key, youtube_id, filename, duration in rows:
+                for song in keyed_songs[key]:
+                    song.youtube_id, song.filename = youtube_id, filename
+                    if song.duration is None:
+                        song.duration = duration
+                    hits.append(song)
+        conn.commit()
+        misses = sum([len(v) for v in keyed_songs.values()]) - len(hits)
+        self.hits += len(hits)
+        self.misses += misses
+        resolution_lookups.inc(len(hits), result="hit")
+        resolution_lookups.inc(misses, result="miss")
+        return hits
+
+    def store(self, song: Song, duration=None):
+        key = get_cache_key(song)
+        if key is None or song.youtube_id is None:
+            return
+        conn = self.get_connection()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO resolutions VALUES (?, ?, ?, ?, ?, ?)",
+            (key, song.youtube_id, song.filename, duration, now, now),
+        )
+        conn.execute("DELETE FROM resolutions WHERE created <= ?", (now - self.ttl,))
+        conn.execute(
+            """DELETE FROM resolutions WHERE key IN (
+                SELECT key FROM resolutions ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )""",
+            (self.max_entries,),
+        )
+        conn.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+        }
+
+
+resolution_cache = ResolutionCache(
+    os.path.join(TEMP_DIR, RESOLUTION_CACHE_FILENAME),
+    RESOLUTION_CACHE_TTL,
+    RESOLUTION_CACHE_SIZE,
+)
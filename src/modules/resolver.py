@@ -0,0 +1,85 @@
+import os
+import time
+import asyncio
+
+from modules.song import Song
+from modules.downloader import Downloader
+from modules.executor import SEARCH_WORKERS
+from modules.resolution_cache import resolution_cache
+from modules.metrics import search_seconds
+
+# Songs of one batch searched at the same time, the search pool is shared by all batches
+RESOLVE_CONCURRENCY = int(os.environ.get("RESOLVE_CONCURRENCY", SEARCH_WORKERS))
+
+
+class BatchResolver:
+    """
+    Resolves the YouTube IDs of a batch of songs ahead of their downloads.
+    Cached resolutions are looked up in bulk, the rest are searched in order with
+    bounded parallelism on the search pool, whose threads keep their YoutubeDL.
+    """
+
+    def __init__(self, download_path: str, concurrency: int = RESOLVE_CONCURRENCY) -> None:
+        self.download_path = download_path
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tasks = {}  # Song -> search task
+        self.started = time.monotonic()
+        self.song_count = 0
+        self.cache_hits = 0
+        self.searched = 0
+        self.failed = 0
+        self.search_seconds = 0.0
+
+    def add(self, songs: list):
+        """Start resolving songs, cache hits are resolved immediately"""
+        self.song_count += len(songs)
+        # Resumed songs may be resolved already
+        songs = [song for song in songs if song.youtube_id is None]
+        hits = resolution_cache.lookup_many([song for song in songs if song.youtube_link is None])
+        self.cache_hits += len(hits)
+        for song in hits:
+            song.message = "Search successful"
+            song.add_log('Search for "' + song.get_display_name() + '" resolved from cache!')
+        resolved = set(hits)
+        for song in songs:
+            if song not in resolved:
+                self.tasks[song] = asyncio.create_task(self.search(song))
+
+    async def search(self, song: Song):
+        async with self.semaphore:
+            start = time.monotonic()
+            downloader = Downloader(self.download_path, logger=song.add_log)
+            await downloader.retrieve_youtube_id(song)
+            elapsed = time.monotonic() - start
+            self.searched += 1
+            self.search_seconds += elapsed
+            search_seconds.observe(elapsed)
+            song.trace.add("search", elapsed)
+            if song.youtube_id is None:
+                self.failed += 1
+
+    async def resolve(self, song: Song):
+        """Wait for the song's resolution, songs never added are resolved on their own"""
+        if song not in self.tasks and song.youtube_id is None:
+            self.add([song])
+        if song in self.tasks:
+            await self.tasks[song]
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "songs": self.song_count,
+            "cache_hits": self.cache_hits,
+            "hit_rate": round(self.cache_hits / self.song_count, 3) if self.song_count else None,
+            "searched": self.searched,
+            "failed": self.failed,
+            "avg_search_seconds": round(self.search_seconds / self.searched, 2) if self.searched else None,
+            "elapsed_seconds": round(time.monotonic() - self.started, 2),
+        }
+
+    def summary(self) -> str:
+        stats = self.stats()
+        return ", ".join([f"{k}: {v}" for k, v in stats.items()])
@@ -0,0 +1,121 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from modules.executor import DOWNLOAD_CONCURRENCY
+
+# Admitting more than the workers can run would queue jobs in the pool, where priorities don't apply
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", DOWNLOAD_CONCURRENCY))
+
+# Lower value is served first
+PRIORITY_SINGLE = 0
+PRIORITY_BULK = 1
+
+
+class Job:
+    def __init__(self, chat_id: int, label: str, priority: int) -> None:
+        self.chat_id = chat_id
+        self.label = label
+        self.priority = priority
+        self.future: asyncio.Future = None
+        self.enqueued_at = time.time()
+        self.started_at = None
+
+    def describe(self) -> str:
+        if self.started_at is None:
+            return f"[{self.chat_id}] {self.label} (waiting {time.time() - self.enqueued_at:.0f}s)"
+        return f"[{self.chat_id}] {self.label} (running {time.time() - self.started_at:.0f}s)"
+
+
+class DownloadScheduler:
+    """
+    Process-wide download admission shared by all handlers.
+    Caps the running jobs globally, serves single tracks before bulk requests
+    and round-robins between chats within the same priority.
+    """
+
+    def __init__(self, max_running: int) -> None:
+        self.max_running = max_running
+        self.queues = {
+            PRIORITY_SINGLE: OrderedDict(),  # chat_id -> deque of jobs
+            PRIORITY_BULK: OrderedDict(),
+        }
+        self.running = []
+
+    def queued_jobs(self):
+        return [
+            job
+            for priority in sorted(self.queues)
+            for chat_queue in self.queues[priority].values()
+            for job in chat_queue
+        ]
+
+    def next_job(self) -> Job:
+        for priority in sorted(self.queues):
+            chat_queues = self.queues[priority]
+            if len(chat_queues) == 0:
+                continue
+            chat_id, chat_queue = next(iter(chat_queues.items()))
+            job = chat_queue.popleft()
+            if len(chat_queue) == 0:
+                del chat_queues[chat_id]
+            else:
+                chat_queues.move_to_end(chat_id)
+            return job
+        return None
+
+    def dispatch(self):
+        while len(self.running) < self.max_running:
+            job = self.next_job()
+            if job is None:
+                return
+            job.started_at = time.time()
+            self.running.append(job)
+            job.future.set_result(True)
+
+    def remove(self, job: Job):
+        chat_queues = self.queues[job.priority]
+        chat_queue = chat_queues.get(job.chat_id)
+        if chat_queue is not None and job in chat_queue:
+            chat_queue.remove(job)
+            if len(chat_queue) == 0:
+                del chat_queues[job.chat_id]
+
+    async def acquire(self, job: Job):
+        job.future = asyncio.get_running_loop().create_future()
+        self.queues[job.priority].setdefault(job.chat_id, deque()).append(job)
+        self.dispatch()
+        try:
+            await job.future
+        except asyncio.CancelledError:
+            if job in self.running:
+                self.release(job)
+            else:
+                self.remove(job)
+            raise
+
+    def release(self, job: Job):
+        if job in self.running:
+            self.running.remove(job)
+        self.dispatch()
+
+    @asynccontextmanager
+    async def slot(self, chat_id: int, label: str, priority: int = PRIORITY_BULK):
+        job = Job(chat_id, label, priority)
+        await self.acquire(job)
+        try:
+            yield job
+        finally:
+            self.release(job)
+
+    def describe(self) -> str:
+        queued = self.queued_jobs()
+        lines = [f"Running {len(self.running)}/{self.max_running}, Queued {len(queued)}"]
+        lines += ["▶️ " + job.describe() for job in self.running]
+        lines += ["⏸ " + job.describe() for job in queued]
+        return "\n".join(lines)
+
+
+scheduler = DownloadScheduler(MAX_CONCURRENT_DOWNLOADS)
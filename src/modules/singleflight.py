@@ -0,0 +1,23 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls sharing a key into one execution.
+    Every caller awaits the same future, so one waiter being cancelled
+    does not cancel the work for the others.
+    """
+
+    def __init__(self) -> None:
+        self.calls = {}
+
+    def in_flight(self, key) -> bool:
+        return key in self.calls
+
+    async def run(self, key, coro_fn):
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(coro_fn())
+            self.calls[key] = future
+            future.add_done_callback(lambda f: self.calls.pop(key, None))
+        return await asyncio.shield(future)
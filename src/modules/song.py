@@ -1,3 +1,22 @@
+from modules.tracing import Trace
+
+# Fields kept when a song is persisted, logs, trace and progress are per run
+SERIALIZED_FIELDS = [
+    "name",
+    "playlist",
+    "spotify_id",
+    "spotify_link",
+    "artists",
+    "duration",
+    "youtube_id",
+    "youtube_link",
+    "filename",
+    "codec",
+    "content_hash",
+    "query",
+]
+
+
 class Song:
     def __init__(self) -> None:
         self.name = None
@@ -9,11 +28,14 @@ class Song:
         self.youtube_id = None
         self.youtube_link = None
         self.filename = None
+        self.codec = None
+        self.content_hash = None
         self.retry_count = 0
         self.bit_rate = None
         self.message = None
         self.query = None
         self.logs = []
+        self.trace = Trace()
 
     def from_spotify_track(spotify_track):
         ret_obj = Song()
@@ -24,6 +46,16 @@ class Song:
         ret_obj.duration = spotify_track["duration_ms"] / 1000  # Store duration in secs
         return ret_obj
 
+    def from_dict(song_dict):
+        ret_obj = Song()
+        for field in SERIALIZED_FIELDS:
+            if field in song_dict:
+                setattr(ret_obj, field, song_dict[field])
+        return ret_obj
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in SERIALIZED_FIELDS}
+
     def from_youtube_link(youtube_link):
         ret_obj = Song()
         ret_obj.youtube_link = youtube_link
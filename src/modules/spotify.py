@@ -1,26 +1,114 @@
+import os
+import time
+import asyncio
+from typing import AsyncIterator, List, Tuple
+
+import requests
 import spotipy
+from requests.adapters import HTTPAdapter
 
 from modules.song import Song
 
+SPOTIFY_CACHE_TTL = int(os.environ.get("SPOTIFY_CACHE_TTL", 3600))
+SPOTIFY_CACHE_SIZE = int(os.environ.get("SPOTIFY_CACHE_SIZE", 512))
+SPOTIFY_POOL_SIZE = 10
+SPOTIFY_PAGE_CONCURRENCY = int(os.environ.get("SPOTIFY_PAGE_CONCURRENCY", 4))
+# Refresh the client credentials token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 300
+
+
+class ClientCredentials(spotipy.oauth2.SpotifyClientCredentials):
+    @staticmethod
+    def is_token_expired(token_info):
+        return token_info["expires_at"] - int(time.time()) < TOKEN_REFRESH_MARGIN
+
+
+class TTLCache:
+    def __init__(self, ttl: int, max_entries: int) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}  # key -> (expires_at, value), in insertion order
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.entries.pop(key, None)
+            return None
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        while len(self.entries) > self.max_entries:
+            del self.entries[next(iter(self.entries))]
+
 
 class Spotify:
     def __init__(self, SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET) -> None:
-        auth_key = spotipy.oauth2.SpotifyClientCredentials(
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=SPOTIFY_POOL_SIZE, pool_maxsize=SPOTIFY_POOL_SIZE)
+        session.mount("https://", adapter)
+        auth_key = ClientCredentials(
             client_id=SPOTIFY_CLIENT_ID,
             client_secret=SPOTIFY_CLIENT_SECRET,
+            requests_session=session,
+            cache_handler=spotipy.cache_handler.MemoryCacheHandler(),
         )
-        self.client = spotipy.Spotify(auth_manager=auth_key)
+        self.client = spotipy.Spotify(auth_manager=auth_key, requests_session=session)
+        self.cache = TTLCache(SPOTIFY_CACHE_TTL, SPOTIFY_CACHE_SIZE)
 
-    def get_album(self, album_link):
-        spotify = self.client
-        songs = spotify.album(album_link)["tracks"]["items"]
-        songs = [Song.from_spotify_track(song) for song in songs]
-        return songs
+    def cached(self, method, *args, **kwargs):
+        """Call a spotipy client method, reusing responses within the cache TTL"""
+        key = (method, args, tuple(sorted(kwargs.items())))
+        response = self.cache.get(key)
+        if response is None:
+            response = getattr(self.client, method)(*args, **kwargs)
+            self.cache.put(key, response)
+        return response
 
-    def get_playlist(self, playlist_link=None, playlist_name=None):
-        spotify = self.client
+    async def fetch(self, method, *args, **kwargs):
+        return await asyncio.to_thread(self.cached, method, *args, **kwargs)
+
+    async def stream_pages(self, method, item_id, first_page, to_songs) -> AsyncIterator[Song]:
+        """Fetch the pages after first_page concurrently and yield their songs in order"""
+        limit = first_page["limit"]
+        page_semaphore = asyncio.Semaphore(SPOTIFY_PAGE_CONCURRENCY)
+
+        async def fetch_page(offset):
+            async with page_semaphore:
+                return await self.fetch(method, item_id, limit=limit, offset=offset)
+
+        tasks = [
+            asyncio.create_task(fetch_page(offset))
+            for offset in range(first_page["offset"] + limit, first_page["total"], limit)
+        ]
+        try:
+            for task in tasks:
+                page = await task
+                for song in to_songs(page["items"]):
+                    yield song
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def stream_album(self, album_link) -> Tuple[List[Song], AsyncIterator[Song], int]:
+        """Returns the songs of the first page, a stream of the remaining ones and the track count"""
+        album = await self.fetch("album", album_link)
+
+        def to_songs(items):
+            return [Song.from_spotify_track(song) for song in items]
+
+        first_page = album["tracks"]
+        return (
+            to_songs(first_page["items"]),
+            self.stream_pages("album_tracks", album["id"], first_page, to_songs),
+            first_page["total"],
+        )
+
+    async def stream_playlist(self, playlist_link=None, playlist_name=None) -> Tuple[List[Song], AsyncIterator[Song], int]:
+        """Returns the songs of the first page, a stream of the remaining ones and the track count"""
         if playlist_name is not None:
-            results = spotify.search(q=playlist_name, type="playlist")
+            results = await self.fetch("search", q=playlist_name, type="playlist")
             results = [
                 (
                     res["name"] + " by " + res["owner"]["display_name"],
@@ -31,13 +119,25 @@ class Spotify:
             ]
             playlist_link = results[0][2]["spotify"]
         
-        playlist = spotify.playlist(playlist_link)
+        playlist = await self.fetch("playlist", playlist_link)
         playlist_name = playlist["name"]
 
-        songs = playlist["tracks"]["items"]
-        songs = [Song.from_spotify_track(song["track"]) for song in songs]
-        for song in songs: song.playlist = playlist_name
-        return songs
+        def to_songs(items):
+            # Removed and local tracks have no track object or ID
+            songs = [
+                Song.from_spotify_track(song["track"])
+                for song in items
+                if song["track"] is not None and song["track"].get("id") is not None
+            ]
+            for song in songs: song.playlist = playlist_name
+            return songs
+
+        first_page = playlist["tracks"]
+        return (
+            to_songs(first_page["items"]),
+            self.stream_pages("playlist_items", playlist["id"], first_page, to_songs),
+            first_page["total"],
+        )
 
     def get_song(self, song_link=None, song_name=None) -> Song:
         spotify = self.client
@@ -60,4 +160,14 @@ class Spotify:
             if 0 < selection <= len(songs):
                 return songs[selection - 1]
 
-        return Song.from_spotify_track(spotify.track(song_link))
+        return Song.from_spotify_track(self.cached("track", song_link))
+
+
+# One client per credentials for the whole process
+spotify_clients = {}
+
+
+def get_spotify(client_id, client_secret) -> Spotify:
+    if (client_id, client_secret) not in spotify_clients:
+        spotify_clients[(client_id, client_secret)] = Spotify(client_id, client_secret)
+    return spotify_clients[(client_id, client_secret)]
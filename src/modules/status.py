@@ -0,0 +1,171 @@
+import os
+import time
+import asyncio
+
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter
+
+from modules.metrics import bot_api_calls, bot_api_retry_after
+
+# Bot API guidance: about 1 message per second per chat and 30 per second overall
+STATUS_CHAT_RATE = float(os.environ.get("STATUS_CHAT_RATE", 1))
+STATUS_CHAT_BURST = float(os.environ.get("STATUS_CHAT_BURST", 3))
+STATUS_GLOBAL_RATE = float(os.environ.get("STATUS_GLOBAL_RATE", 25))
+# Chat actions are displayed for 5 seconds
+CHAT_ACTION_INTERVAL = 4
+MAX_ATTEMPTS = 3
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            self.refill()
+            wait = max(self.blocked_until - time.monotonic(), 0)
+            if wait == 0 and self.tokens >= 1:
+                self.tokens -= 1
+                return
+            if wait == 0:
+                wait = (1 - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+
+def get_retry_seconds(e: RetryAfter) -> float:
+    if isinstance(e.retry_after, (int, float)):
+        return e.retry_after
+    return e.retry_after.total_seconds()
+
+
+def rewind_files(kwargs: dict):
+    """File objects are read to the end by every attempt, a retry must send them from the start"""
+    for value in kwargs.values():
+        if hasattr(value, "seek"):
+            value.seek(0)
+
+
+def get_message_key(msg: Message):
+    return (msg.chat_id, msg.message_id)
+
+
+class StatusUpdater:
+    """
+    Funnels Bot API calls through per-chat and global token buckets and honours retry_after.
+    Status message edits are coalesced per message: only the latest pending text is sent,
+    superseded intermediate states are dropped.
+    """
+
+    def __init__(self) -> None:
+        self.global_bucket = TokenBucket(STATUS_GLOBAL_RATE, STATUS_GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.pending_edits = {}  # message key -> latest text
+        # message key -> text last scheduled, only for edited messages until they're deleted
+        self.sent_texts = {}
+        self.edit_tasks = {}
+        self.chat_actions = {}  # chat_id -> (action, monotonic time)
+        self.stats = {"calls": 0, "dropped_edits": 0, "retry_after": 0}
+
+    def get_chat_bucket(self, chat_id) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(STATUS_CHAT_RATE, STATUS_CHAT_BURST)
+        return self.chat_buckets[chat_id]
+
+    async def call(self, chat_id, fn, /, *args, **kwargs):
+        """Run a Bot API call within the rate budgets, retrying after flood control"""
+        chat_bucket = self.get_chat_bucket(chat_id)
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt > 0:
+                rewind_files(kwargs)
+            await chat_bucket.acquire()
+            await self.global_bucket.acquire()
+            self.stats["calls"] += 1
+            bot_api_calls.inc(method=getattr(fn, "__name__", "call"))
+            try:
+                return await fn(*args, **kwargs)
+            except RetryAfter as e:
+                self.stats["retry_after"] += 1
+                bot_api_retry_after.inc()
+                print(f"Flood control for chat {chat_id}, retrying after {get_retry_seconds(e)}s")
+                chat_bucket.block(get_retry_seconds(e))
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+
+    async def send_message(self, bot, chat_id, text, **kwargs) -> Message:
+        return await self.call(chat_id, bot.send_message, chat_id=chat_id, text=text, **kwargs)
+
+    def get_text(self, msg: Message):
+        """Messages that were never edited still have the text they were sent with"""
+        return self.sent_texts.get(get_message_key(msg), msg.text)
+
+    def edit(self, msg: Message, text: str):
+        """Schedule an edit without waiting for it, newer texts replace pending ones"""
+        key = get_message_key(msg)
+        if text == self.get_text(msg):
+            return
+        if key in self.pending_edits:
+            self.stats["dropped_edits"] += 1
+        self.pending_edits[key] = text
+        self.sent_texts[key] = text
+        if key not in self.edit_tasks:
+            self.edit_tasks[key] = asyncio.create_task(self.flush_edits(msg))
+
+    async def flush_edits(self, msg: Message):
+        key = get_message_key(msg)
+        try:
+            while key in self.pending_edits:
+                await self.get_chat_bucket(msg.chat_id).acquire()
+                text = self.pending_edits.pop(key, None)
+                if text is None:
+                    break
+                try:
+                    # The chat budget was just taken, only the global one is left
+                    await self.global_bucket.acquire()
+                    self.stats["calls"] += 1
+                    bot_api_calls.inc(method="edit_text")
+                    await msg.edit_text(text)
+                except RetryAfter as e:
+                    self.stats["retry_after"] += 1
+                    bot_api_retry_after.inc()
+                    self.get_chat_bucket(msg.chat_id).block(get_retry_seconds(e))
+                    # Retry unless a newer text arrived meanwhile
+                    self.pending_edits.setdefault(key, text)
+                except BadRequest as e:
+                    if "not modified" not in str(e):
+                        print(f"Status edit failed: {e}")
+                except Exception as e:
+                    print(f"Status edit failed: {e}")
+        finally:
+            self.edit_tasks.pop(key, None)
+
+    async def send_action(self, bot, chat_id, action):
+        last_action = self.chat_actions.get(chat_id)
+        now = time.monotonic()
+        if last_action is not None and last_action[0] == action and now - last_action[1] < CHAT_ACTION_INTERVAL:
+            return
+        self.chat_actions[chat_id] = (action, now)
+        await self.call(chat_id, bot.send_chat_action, chat_id=chat_id, action=action)
+
+    async def delete(self, msg: Message):
+        key = get_message_key(msg)
+        self.pending_edits.pop(key, None)
+        self.sent_texts.pop(key, None)
+        task = self.edit_tasks.pop(key, None)
+        if task is not None:
+            task.cancel()
+        await self.call(msg.chat_id, msg.delete)
+
+
+status_updater = StatusUpdater()
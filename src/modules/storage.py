@@ -1,38 +1,25 @@
 import os
-import uuid
+import time
 import asyncio
-from datetime import datetime, timedelta
 import json
-import zipfile
 
 from modules.song import Song
+from modules.index_store import (
+    IndexStore,
+    get_index_store,
+    FILENAME_FIELD,
+    FILE_ID_FIELD,
+    CODEC_FIELD,
+    CONTENT_HASH_FIELD,
+)
+from modules.blob_store import BlobStore, BLOB_DIR_NAME, hash_file
+from modules.job_store import JobStore, get_job_store
+from modules.locking import get_lock, write_json_atomic
+from modules.tracing import merge_slow_entries
 
 LOG_FILENAME = "logfile.txt"
-INDEX_FILENAME = "index.json"
 USERS_FILENAME = "users.json"
-FILENAME_FIELD = "filename"
-TIMESTAMP_FIELD = "timestamp"
-UPLOADED_FIELD = "uploaded"
-
-
-def add_to_index(filename: str):
-    return {
-        FILENAME_FIELD: filename,
-        TIMESTAMP_FIELD: datetime.utcnow().isoformat(),
-        UPLOADED_FIELD: False,
-    }
-
-
-def rebuild_index(base_index={}):
-    return {
-        **base_index,
-        "INDEX": add_to_index(INDEX_FILENAME),
-        "LOG": add_to_index(LOG_FILENAME),
-    }
-
-
-def set_uploaded(obj):
-    obj[UPLOADED_FIELD] = True
+SLOW_LOG_FILENAME = "slow_requests.json"
 
 
 def incomplete_download(filepath: str):
@@ -42,47 +29,81 @@ def incomplete_download(filepath: str):
 class Storage:
     def __init__(self, storage_location) -> None:
         self.storage_location = storage_location
-        self.logfile_lock = asyncio.Lock()
         self.logfile_path = os.path.join(self.storage_location, LOG_FILENAME)
-        self.usersfile_lock = asyncio.Lock()
         self.usersfile_path = os.path.join(self.storage_location, USERS_FILENAME)
-        if os.path.exists(self.usersfile_path):
-            try:
-                with open(self.usersfile_path, "r") as f:
-                    self.usersdict = json.load(f)
-            except:
-                self.usersdict = {}
-        else:
-            self.usersdict = {}
-        
-        self.index_path = os.path.join(self.storage_location, INDEX_FILENAME)
-        if os.path.exists(self.index_path):
-            self.index = self.load_index()
-        else:
-            self.index = rebuild_index()
+        self.slowlog_path = os.path.join(self.storage_location, SLOW_LOG_FILENAME)
+        self.usersdict = self.read_usersfile()
+
+        self.index: IndexStore = get_index_store(self.storage_location)
+        self.blobs = BlobStore(self.storage_location)
+        self.jobs: JobStore = get_job_store(self.storage_location)
     
     def get_location(self):
         return self.storage_location
     
-    async def add_to_logfile(self, log_string):
-        async with self.logfile_lock:
+    # The log and users files are shared by every process using the storage location,
+    # their locks are file locks taken off the event loop
+
+    def append_logfile(self, log_string):
+        with get_lock(self.storage_location, "logfile"):
             with open(self.logfile_path, "a", encoding="utf-8") as f:
                 f.write(log_string + "\n")
                 f.flush()
-    
-    async def get_logs(self):
-        async with self.logfile_lock:
+
+    async def add_to_logfile(self, log_string):
+        await asyncio.to_thread(self.append_logfile, log_string)
+
+    def read_logfile(self):
+        with get_lock(self.storage_location, "logfile"):
             with open(self.logfile_path, "r", encoding="utf-8") as f:
                 return f.read()
-    
+
+    async def get_logs(self):
+        return await asyncio.to_thread(self.read_logfile)
+
+    def read_usersfile(self):
+        if not os.path.exists(self.usersfile_path):
+            return {}
+        try:
+            with open(self.usersfile_path, "r") as f:
+                return json.load(f)
+        except:
+            return {}
+
+    def update_usersfile(self, user_id, chat_id):
+        with get_lock(self.storage_location, "users"):
+            # Re-read under the lock, other processes may have added users since
+            self.usersdict = self.read_usersfile()
+            # JSON keys are strings
+            chat_ids = self.usersdict.setdefault(str(user_id), [])
+            if chat_id not in chat_ids:
+                chat_ids.append(chat_id)
+                write_json_atomic(self.usersfile_path, self.usersdict, indent=2)
+
     async def add_to_usersfile(self, user_id, chat_id):
-        async with self.usersfile_lock:
-            if user_id not in self.usersdict:
-                self.usersdict[user_id] = [chat_id]
-            elif chat_id not in self.usersdict[user_id]:
-                self.usersdict[user_id].append(chat_id)
-            with open(self.usersfile_path, "w") as f:
-                json.dump(self.usersdict, f, indent=2)
+        await asyncio.to_thread(self.update_usersfile, user_id, chat_id)
+
+    def read_slowlog(self):
+        if not os.path.exists(self.slowlog_path):
+            return []
+        try:
+            with open(self.slowlog_path, "r") as f:
+                return json.load(f)
+        except:
+            return []
+
+    def update_slowlog(self, entries):
+        """Keep the slowest songs seen so far, entries are made by tracing.get_slow_entry"""
+        with get_lock(self.storage_location, "slowlog"):
+            write_json_atomic(
+                self.slowlog_path, merge_slow_entries(self.read_slowlog(), entries), indent=2
+            )
+
+    async def add_to_slowlog(self, entries):
+        await asyncio.to_thread(self.update_slowlog, entries)
+
+    async def get_slowlog(self):
+        return await asyncio.to_thread(self.read_slowlog)
                 
     def get_downloaded_filepaths(self):
         return [
@@ -90,73 +111,126 @@ class Storage:
             for file in os.listdir(self.storage_location)
         ]
 
-    def load_index(self):
-        with open(self.index_path, "r") as f:
-            return json.load(f)
+    def get_reserved_filenames(self):
+        return [LOG_FILENAME, USERS_FILENAME, SLOW_LOG_FILENAME, BLOB_DIR_NAME] + self.get_database_filenames()
 
-    def save_index(self):
-        with open(self.index_path, "w") as f:
-            json.dump(self.index, f, indent=2)
+    def get_database_filenames(self):
+        return self.index.database_filenames() + self.jobs.database_filenames()
+
+    def clean_files(self, grace_seconds: float = 0):
+        """Remove unindexed files, files linked less than grace_seconds ago may not be indexed yet"""
+        self.sweep_files(self.index.filenames(), self.index.content_hashes(), grace_seconds)
         return
 
-    def clean_files(self):
-        updated_filepaths = [
-            os.path.join(self.storage_location, v[FILENAME_FIELD])
-            for v in self.index.values()
-        ]
+    def sweep_files(self, indexed_filenames: set, referenced_hashes: set, grace_seconds: float):
+        """
+        Filesystem part of clean_files, without index access so it can run in a thread.
+        """
+        kept_filenames = indexed_filenames.union(self.get_reserved_filenames())
         for fp in self.get_downloaded_filepaths():
-            if (fp not in updated_filepaths) and not incomplete_download(fp):
+            if os.path.isdir(fp):
+                continue
+            if (os.path.basename(fp) not in kept_filenames) and not incomplete_download(fp):
+                if time.time() - os.lstat(fp).st_ctime < grace_seconds:
+                    continue
                 os.remove(fp)
+        with get_lock(self.storage_location, "blobs"):
+            self.blobs.collect_garbage(referenced_hashes, grace_seconds)
         return
 
-    def clear_outdated(self):
-        now = datetime.utcnow()
-        delta = timedelta(days=3)
-        self.index = {
-            k: v
-            for k, v in self.index.items()
-            if (now - datetime.fromisoformat(v[TIMESTAMP_FIELD]) < delta)
-            and (os.path.exists(os.path.join(self.storage_location, v[FILENAME_FIELD])))
-        }
-        self.index = rebuild_index(self.index)
-        self.clean_files()
-        return
+    def find_missing(self, entries: list):
+        """YouTube IDs of the entries whose file is gone, stats every file"""
+        return [
+            v["youtube_id"]
+            for v in entries
+            # Uploaded songs can still be sent by file_id without the local file
+            if v[FILE_ID_FIELD] is None
+            and not os.path.exists(self.get_filepath(v[FILENAME_FIELD]))
+        ]
 
     def clear_uploaded(self):
-        self.index = {k: v for k, v in self.index.items() if not v[UPLOADED_FIELD]}
+        self.index.delete_uploaded()
         self.clean_files()
         return
 
     def reset_directory(self):
+        reserved_filenames = self.get_database_filenames()
         for fp in self.get_downloaded_filepaths():
-            os.remove(fp)
-        self.index = rebuild_index()
-        self.save_index()
+            if os.path.basename(fp) not in reserved_filenames and not os.path.isdir(fp):
+                os.remove(fp)
+        self.blobs.clear()
+        self.index.clear()
         return
 
-    def find_file(self, song: Song):
-        if song.filename in os.listdir(self.storage_location):
+    async def find_file(self, song: Song):
+        """
+        Whether the song's audio is stored, decided by its index entry only:
+        the title based song.filename may be another song's file with the same title.
+        """
+        # The indexed filename has the actual extension, which depends on the output policy
+        entry = self.get_index(song)
+        if entry is None:
+            return False
+        if not self.index.has_file(entry[FILENAME_FIELD]) and entry[CONTENT_HASH_FIELD] is not None:
+            # The name was cleared but the audio may still be stored under another name
+            await asyncio.to_thread(self.relink, entry[FILENAME_FIELD], entry[CONTENT_HASH_FIELD])
+        if self.index.has_file(entry[FILENAME_FIELD]):
+            song.filename = entry[FILENAME_FIELD]
+            song.codec = entry[CODEC_FIELD]
+            song.content_hash = entry[CONTENT_HASH_FIELD]
             return True
         return False
 
+    def relink(self, filename: str, content_hash: str):
+        """Link filename to the blob with content_hash if it is still stored. Blocking, waits for the blobs lock"""
+        with get_lock(self.storage_location, "blobs"):
+            blob_path = self.blobs.find(content_hash)
+            if blob_path is not None:
+                self.blobs.link(blob_path, self.get_filepath(filename))
+
+    def has_song_file(self, song: Song):
+        """Whether song.filename is stored, once it is the name the download was linked under"""
+        return self.index.has_file(song.filename)
+
+    def get_incoming_path(self, song: Song):
+        """Download target named by YouTube ID, so downloads with equal titles never collide"""
+        extension = os.path.splitext(song.filename)[1]
+        return self.blobs.get_incoming_path(song.youtube_id + extension)
+
+    def store_download(self, song: Song, display_filename: str):
+        """
+        Move the downloaded song.filename from the incoming directory into the blob store
+        and link it under display_filename with the actual extension.
+        Blocking, hashes the whole file.
+        """
+        incoming_path = self.blobs.get_incoming_path(song.filename)
+        content_hash = hash_file(incoming_path)
+        # Other processes may store the same audio or collect garbage meanwhile
+        with get_lock(self.storage_location, "blobs"):
+            return self.link_download(song, incoming_path, content_hash, display_filename)
+
+    def link_download(self, song: Song, incoming_path: str, content_hash: str, display_filename: str):
+        song.content_hash, blob_path = self.blobs.add(incoming_path, content_hash)
+        extension = os.path.splitext(blob_path)[1]
+        filename = os.path.splitext(display_filename)[0] + extension
+        if os.path.exists(self.get_filepath(filename)) and not self.blobs.is_linked(
+            blob_path, self.get_filepath(filename)
+        ):
+            # Different audio with the same title
+            filename = f"{os.path.splitext(display_filename)[0]} [{song.youtube_id}]{extension}"
+        if not self.blobs.is_linked(blob_path, self.get_filepath(filename)):
+            self.blobs.link(blob_path, self.get_filepath(filename))
+        song.filename = filename
+        return filename
+
     def get_index(self, song: Song):
-        try:
-            return self.index[song.youtube_id]
-        except:
+        if song.youtube_id is None:
             return None
+        return self.index.get(song.youtube_id)
 
     def get_filepath(self, filename: str):
         return os.path.join(self.storage_location, filename)
     
-    def get_zipped(self, filenames):
-        filepaths = [self.get_filepath(filename) for filename in filenames]
-        zip_filename = uuid.uuid4().hex + ".zip"
-        zip_filename = self.get_filepath(zip_filename)
-        with zipfile.ZipFile(zip_filename, "w") as zip_file:
-            for filepath,filename in zip(filepaths,filenames):
-                zip_file.write(filepath, filename)
-        return zip_filename
-
     def finalize_filename(self, song: Song):
         extension = song.filename.split(".")[-1]
         new_filename = song.get_display_name() + "." + extension
@@ -165,9 +239,27 @@ class Storage:
         return
 
     def update_index(self, song: Song):
-        self.index[song.youtube_id] = add_to_index(song.filename)
+        self.index.upsert(
+            song.youtube_id, song.spotify_id, song.filename, song.codec, song.content_hash
+        )
         return
 
-    def mark_uploaded(self, song: Song):
-        set_uploaded(self.index[song.youtube_id])
+    def record_access(self, song: Song):
+        self.index.record_access(song.youtube_id)
         return
+
+    def mark_uploaded(self, song: Song, file_id=None):
+        self.index.set_uploaded(song.youtube_id, file_id)
+        return
+
+    def get_file_id(self, song: Song):
+        entry = self.get_index(song)
+        if entry is None:
+            return None
+        return entry[FILE_ID_FIELD]
+
+    def get_indexed_filename(self, song: Song):
+        entry = self.get_index(song)
+        if entry is None:
+            return None
+        return entry[FILENAME_FIELD]
@@ -0,0 +1,100 @@
+import os
+import time
+
+# Pipeline stages in the order a song goes through them.
+# search is part of resolve and transcode is part of download, the rest don't overlap.
+STAGES = ["resolve", "search", "download", "transcode", "zip", "upload"]
+# Slowest songs kept in the persisted slow-request log
+SLOW_LOG_SIZE = int(os.environ.get("SLOW_LOG_SIZE", 20))
+
+
+class Trace:
+    """Monotonic timings of the stages a song went through in a batch"""
+
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.spans = []  # (stage, start offset, seconds)
+
+    def start(self):
+        self.started = time.monotonic()
+        self.spans = []
+
+    def span(self, stage: str):
+        return Span(self, stage)
+
+    def add(self, stage: str, seconds: float, start: float = None):
+        """Record a stage timed elsewhere, e.g. in a worker process"""
+        if start is None:
+            start = time.monotonic() - seconds
+        self.spans.append((stage, start - self.started, seconds))
+
+    def stage_seconds(self) -> dict:
+        totals = {}
+        for stage, _, seconds in self.spans:
+            totals[stage] = totals.get(stage, 0) + seconds
+        return totals
+
+    def total_seconds(self) -> float:
+        """Time from the start of the song until its last stage ended"""
+        return max([offset + seconds for _, offset, seconds in self.spans], default=0)
+
+    def describe(self) -> str:
+        return format_stages(self.total_seconds(), self.stage_seconds())
+
+
+class Span:
+    def __init__(self, trace: Trace, stage: str) -> None:
+        self.trace = trace
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        self.trace.add(self.stage, time.monotonic() - self.start, self.start)
+
+
+def format_stage_times(stages: dict) -> str:
+    return ", ".join([f"{stage} {stages[stage]:.1f}s" for stage in STAGES if stage in stages])
+
+
+def format_stages(total: float, stages: dict) -> str:
+    if len(stages) == 0:
+        return f"total {total:.1f}s"
+    return f"total {total:.1f}s, " + format_stage_times(stages)
+
+
+def summarize_batch(songs: list, wall_seconds: float) -> str:
+    """One line with the stage times summed over the batch and its slowest song"""
+    totals = {}
+    for song in songs:
+        for stage, seconds in song.trace.stage_seconds().items():
+            totals[stage] = totals.get(stage, 0) + seconds
+    summary = f"songs: {len(songs)}, wall {wall_seconds:.1f}s, summed {format_stage_times(totals)}"
+    if len(songs) > 0:
+        slowest = max(songs, key=lambda song: song.trace.total_seconds())
+        summary += f", slowest: {slowest.get_display_name()} ({slowest.trace.total_seconds():.1f}s)"
+    return summary
+
+
+def get_slow_entry(song, chat_id) -> dict:
+    return {
+        "name": song.get_display_name(),
+        "youtube_id": song.youtube_id,
+        "chat_id": chat_id,
+        "message": song.message,
+        "time": time.time(),
+        "total_seconds": round(song.trace.total_seconds(), 2),
+        "stages": {k: round(v, 2) for k, v in song.trace.stage_seconds().items()},
+    }
+
+
+def merge_slow_entries(entries: list, new_entries: list, size: int = SLOW_LOG_SIZE) -> list:
+    return sorted(entries + new_entries, key=lambda entry: entry["total_seconds"], reverse=True)[:size]
+
+
+def format_slow_entry(entry: dict) -> str:
+    when = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["time"]))
+    return f"{when} {entry['name']} [{entry['youtube_id']}] {entry['message']}\n    {format_stages(entry['total_seconds'], entry['stages'])}"
@@ -3,7 +3,11 @@ import subprocess
 import uuid
 import os
 
+from modules.metrics import read_snapshots, render_metrics
+
 WEBSHELL_PASSWORD = os.getenv('WEBSHELL_PASSWORD')
+# Served without login so scrapers can reach it, choose an unguessable path if needed
+METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')
 
 
 def shell_process():
@@ -149,6 +153,11 @@ def shell_process():
         </html>
         """
 
+    @app.route(METRICS_PATH)
+    def metrics():
+        # Snapshots are written by the bot and worker processes
+        return Response(render_metrics(read_snapshots()), mimetype='text/plain; version=0.0.4')
+
     @app.route('/run_command')
     def run_command():
         cmd = request.args.get('command', '')
@@ -0,0 +1,49 @@
+import os
+import time
+import socket
+from traceback import format_exception
+
+from modules.broker import broker, BROKER_POLL_INTERVAL
+from modules.executor import init_broker_reporting
+from modules.downloader import search_job, download_job
+from modules.metrics import registry, worker_tasks, worker_task_seconds, METRICS_FLUSH_INTERVAL
+
+# Jobs the bot can hand to workers, by function name
+JOB_FUNCTIONS = {fn.__name__: fn for fn in (search_job, download_job)}
+# Searches are short and block the start of downloads, they are claimed first
+WORKER_QUEUES = os.environ.get("WORKER_QUEUES", "search,download").split(",")
+
+
+def worker_process():
+    """Pull search and download jobs from the broker, one at a time"""
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    init_broker_reporting(broker)
+    print(f"Worker {worker_id} polling {', '.join(WORKER_QUEUES)}")
+    metrics_written = 0
+    while True:
+        if time.monotonic() - metrics_written > METRICS_FLUSH_INTERVAL:
+            registry.write_snapshot("worker")
+            metrics_written = time.monotonic()
+        task = None
+        for queue in WORKER_QUEUES:
+            task = broker.claim(queue, worker_id)
+            if task is not None:
+                break
+        if task is None:
+            time.sleep(BROKER_POLL_INTERVAL)
+            continue
+        start = time.monotonic()
+        try:
+            result = JOB_FUNCTIONS[task["fn"]](*task["args"])
+            broker.complete(task["id"], result)
+            worker_tasks.inc(fn=task["fn"], result="ok")
+        except Exception as e:
+            print(f"Worker {worker_id} job {task['fn']} failed:", "".join(format_exception(None, e, e.__traceback__)))
+            broker.fail(task["id"], str(e))
+            worker_tasks.inc(fn=task["fn"], result="failed")
+        worker_task_seconds.observe(time.monotonic() - start, fn=task["fn"])
+
+
+if __name__ == "__main__":
+    # Workers started on their own share BROKER_PATH and DOWNLOAD_PATH with the bot, on the same host
+    worker_process()